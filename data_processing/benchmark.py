@@ -0,0 +1,219 @@
+#!/usr/bin/env python
+#
+# Funf: Open Sensing Framework
+# Copyright (C) 2010-2011 Nadav Aharony, Wei Pan, Alex Pentland.
+# Acknowledgments: Alan Gardner
+# Contact: nadav@media.mit.edu
+# 
+# This file is part of Funf.
+# 
+# Funf is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as
+# published by the Free Software Foundation, either version 3 of
+# the License, or (at your option) any later version.
+# 
+# Funf is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the GNU Lesser General Public License for more details.
+# 
+# You should have received a copy of the GNU Lesser General Public
+# License along with Funf. If not, see <http://www.gnu.org/licenses/>.
+# 
+
+'''Micro-benchmarks for the data processing scripts.
+'''
+from optparse import OptionParser
+import sqlite3
+import simplejson as json
+import timeit
+import time
+import tempfile
+import shutil
+import os
+import sys
+import random
+from itertools import dropwhile
+
+_builtin_probe_prefix = 'edu.mit.media.funf.probe.builtin.'
+
+# Payloads as recorded by the builtin probes
+sample_values = {
+    _builtin_probe_prefix + 'WifiProbe': '''{"PROBE": "edu.mit.media.funf.probe.builtin.WifiProbe", "TIMESTAMP": 1316188972, "SCAN_RESULTS": [
+        {"BSSID": "00:1a:1e:81:96:a1", "SSID": "MIT", "capabilities": "", "frequency": 2437, "level": -67},
+        {"BSSID": "00:1a:1e:81:96:a0", "SSID": "MIT GUEST", "capabilities": "", "frequency": 2437, "level": -68},
+        {"BSSID": "00:1a:1e:81:96:a2", "SSID": "MIT SECURE", "capabilities": "[WPA2-EAP-CCMP]", "frequency": 2437, "level": -69},
+        {"BSSID": "00:1a:1e:81:8d:41", "SSID": "MIT", "capabilities": "", "frequency": 2462, "level": -81},
+        {"BSSID": "00:24:b2:5c:41:72", "SSID": "NETGEAR", "capabilities": "[WPA-PSK-TKIP+CCMP][WPA2-PSK-TKIP+CCMP][WPS]", "frequency": 2412, "level": -88}]}''',
+    _builtin_probe_prefix + 'BluetoothProbe': '''{"PROBE": "edu.mit.media.funf.probe.builtin.BluetoothProbe", "TIMESTAMP": 1316188983, "DEVICES": [
+        {"android.bluetooth.device.extra.DEVICE": {"mAddress": "00:1E:52:7A:43:90"}, "android.bluetooth.device.extra.NAME": "MacBook", "android.bluetooth.device.extra.RSSI": -71, "android.bluetooth.device.extra.CLASS": {"mClass": 3670284}},
+        {"android.bluetooth.device.extra.DEVICE": {"mAddress": "5C:59:48:11:0B:2E"}, "android.bluetooth.device.extra.NAME": "Nexus One", "android.bluetooth.device.extra.RSSI": -84, "android.bluetooth.device.extra.CLASS": {"mClass": 5898764}}]}''',
+    _builtin_probe_prefix + 'LocationProbe': '''{"PROBE": "edu.mit.media.funf.probe.builtin.LocationProbe", "TIMESTAMP": 1316189012, "LOCATION": {
+        "mAccuracy": 48.0, "mAltitude": 0.0, "mBearing": 0.0, "mDistance": 0.0, "mElapsedRealtime": 0, "mExtras": {"networkLocationSource": "cached", "networkLocationType": "wifi"},
+        "mHasAccuracy": true, "mHasAltitude": false, "mHasBearing": false, "mHasSpeed": false, "mInitialBearing": 0.0, "mIsFromMockProvider": false,
+        "mLat1": 0.0, "mLat2": 0.0, "mLatitude": 42.3604634, "mLon1": 0.0, "mLon2": 0.0, "mLongitude": -71.0872183, "mProvider": "network", "mResults": [0.0, 0.0], "mSpeed": 0.0, "mTime": 1316189011915}}'''
+}
+
+def sample_values_from_db(db_file, probes, limit=1000):
+    '''Returns up to limit recorded values for each probe in a merged db file'''
+    conn = sqlite3.connect(db_file)
+    probe_to_values = {}
+    for probe in probes:
+        values = [row[0] for row in conn.execute("select value from data where probe=? limit ?", (probe, limit))]
+        if values:
+            probe_to_values[probe] = values
+    conn.close()
+    return probe_to_values
+
+def _time_per_value(function, values, number):
+    seconds = min(timeit.repeat(lambda: [function(value) for value in values], repeat=3, number=number))
+    return seconds / (number * len(values))
+
+def benchmark_flatten(probe_to_values, number=1000):
+    '''Compares flatten_values with the compiled ProbeFlattener on each probe's values'''
+    from db2csv import flatten_values, ProbeFlattener
+    print "%-50s %12s %12s %8s" % ("Flatten", "generic us", "compiled us", "speedup")
+    for probe, values in sorted(probe_to_values.items()):
+        values = [json.loads(value) for value in values]
+        flattener = ProbeFlattener()
+        assert [flattener(value) for value in values] == [flatten_values(value) for value in values]
+        generic = _time_per_value(flatten_values, values, number)
+        compiled = _time_per_value(flattener, values, number)
+        print "%-50s %12.2f %12.2f %7.1fx" % (probe.replace(_builtin_probe_prefix, '', 1), generic * 1e6, compiled * 1e6, generic / compiled)
+
+def make_funf_db(file_name, uuid, device, values):
+    '''Creates a db file with the tables the Funf app writes, holding the given (probe, timestamp, value) rows'''
+    conn = sqlite3.connect(file_name)
+    conn.execute('create table file_info (_id integer primary key autoincrement, name text, device text, uuid text, created long)')
+    conn.execute('create table data (_id integer primary key autoincrement, name text, timestamp long, value text)')
+    conn.execute('insert into file_info (name, device, uuid, created) values (?, ?, ?, ?)', (os.path.basename(file_name), device, uuid, int(time.time())))
+    conn.executemany('insert into data (name, timestamp, value) values (?, ?, ?)', values)
+    conn.commit()
+    conn.close()
+
+def _synthetic_values(rows):
+    probes = sorted(sample_values)
+    return [(probes[i % len(probes)], 1316188972 + i, sample_values[probes[i % len(probes)]]) for i in xrange(rows)]
+
+def benchmark_merge(files=100, rows_per_file=1000):
+    '''Reports rows/sec for merging synthetic Funf db files row by row and in bulk'''
+    from dbmerge import merge
+    work_dir = tempfile.mkdtemp()
+    try:
+        values = _synthetic_values(rows_per_file)
+        db_files = [os.path.join(work_dir, 'funf_%d.db' % i) for i in xrange(files)]
+        for i, db_file in enumerate(db_files):
+            make_funf_db(db_file, 'uuid-%d' % i, 'device-%d' % (i % 10), values)
+        print "%-50s %12s %12s" % ("Merge %d files of %d rows" % (files, rows_per_file), "seconds", "rows/sec")
+        for name, bulk in (("row by row", False), ("bulk", True)):
+            out_file = os.path.join(work_dir, 'merged_%s.db' % bulk)
+            stdout, sys.stdout = sys.stdout, open(os.devnull, 'w')
+            try:
+                start = time.time()
+                merge(db_files, out_file, attempt_salvage=False, bulk=bulk)
+                seconds = time.time() - start
+            finally:
+                sys.stdout.close()
+                sys.stdout = stdout
+            print "%-50s %12.2f %12d" % (name, seconds, files * rows_per_file / seconds)
+    finally:
+        shutil.rmtree(work_dir)
+
+def synthetic_device_history(days=365, period=300, configuration_interval=86400, probe=_builtin_probe_prefix + 'WifiProbe'):
+    '''Returns timestamps of a probe sampled about every period seconds with occasional outages, 
+    and configurations pushed every configuration_interval seconds that alternate the probe's PERIOD'''
+    random.seed(0)
+    start = 1316188972
+    end = start + days * 86400
+    confs = [(timestamp, {"dataRequests": {probe: [{"PERIOD": period * (1 + i % 2), "DURATION": 30}]}}) 
+             for i, timestamp in enumerate(xrange(start, end, configuration_interval))]
+    ts = []
+    timestamp = start + 1
+    while timestamp < end:
+        ts.append(timestamp)
+        timestamp += random.randint(period - 30, period + 30) + (random.randint(3600, 36000) if random.random() < 0.001 else 0)
+    return probe, ts, confs
+
+def benchmark_data_gaps(days=365):
+    '''Compares classifying the gaps in a synthetic device history with a PeriodIndex and with a linear lookup of the period'''
+    import report
+    class LinearPeriodIndex(report.PeriodIndex):
+        def period_change(self, time):
+            return next(dropwhile(lambda x: x[0] >= time, reversed(self.period_changes)), self.no_period_change)
+    
+    probe, ts, confs = synthetic_device_history(days)
+    probe_time_gaps = zip(ts, report.time_gaps(ts))
+    period_changes = report.probe_period_changes(confs, probe)
+    print "%-50s %12s %12s" % ("Data gaps in %d days, %d samples, %d changes" % (days, len(ts), len(period_changes)), "seconds", "gaps")
+    for name, index_class in (("linear lookup", LinearPeriodIndex), ("period index", report.PeriodIndex)):
+        start = time.time()
+        gaps = report.data_gaps(probe_time_gaps, confs, probe, 'device', index_class(period_changes))
+        print "%-50s %12.2f %12d" % (name, time.time() - start, len(gaps))
+
+def _decrypt_by_block(encrypted_file, output_file, decryptor):
+    '''Decrypts one block per cipher call, as decrypt did before it read in buffers'''
+    from decrypt import remove_padding, _block_size
+    data = encrypted_file.read(_block_size)
+    while data:
+        next_data = encrypted_file.read(_block_size)
+        decrypted = decryptor.decrypt(data)
+        if not next_data:
+            decrypted = remove_padding(decrypted)
+        output_file.write(decrypted)
+        data = next_data
+
+def benchmark_decrypt(megabytes=16):
+    '''Reports MB/sec for decrypting a synthetic encrypted file a block at a time and in large buffers'''
+    from Crypto.Cipher import DES
+    import decrypt
+    key = decrypt.key_from_password(decrypt.default_password)
+    work_dir = tempfile.mkdtemp()
+    try:
+        data = os.urandom(megabytes * 1024 * 1024 + 3)
+        padding = decrypt._block_size - len(data) % decrypt._block_size
+        encrypted_file = os.path.join(work_dir, 'encrypted.db')
+        with open(encrypted_file, 'wb') as output_file:
+            output_file.write(DES.new(key).encrypt(data + chr(padding) * padding))
+        print "%-50s %12s %12s" % ("Decrypt %d MB" % megabytes, "seconds", "MB/sec")
+        for name, decrypt_stream in (("block by block", _decrypt_by_block), ("buffered", decrypt.decrypt_stream)):
+            decrypted_file = os.path.join(work_dir, 'decrypted.db')
+            start = time.time()
+            with open(encrypted_file, 'rb') as input_file:
+                with open(decrypted_file, 'wb') as output_file:
+                    decrypt_stream(input_file, output_file, DES.new(key))
+            seconds = time.time() - start
+            with open(decrypted_file, 'rb') as decrypted:
+                assert decrypted.read() == data
+            print "%-50s %12.2f %12.1f" % (name, seconds, megabytes / seconds)
+    finally:
+        shutil.rmtree(work_dir)
+
+
+if __name__ == '__main__':
+    usage = "%prog [options]"
+    description = "Runs micro-benchmarks of the data processing scripts."
+    parser = OptionParser(usage="%s\n\n%s" % (usage, description))
+    parser.add_option("-d", "--database", dest="db_file", default=None,
+                      help="Merged db file to take probe values from, instead of the builtin samples.", metavar="FILE")
+    parser.add_option("-n", "--number", dest="number", default=1000, type="int",
+                      help="Number of times to run each benchmark.  Defaults to 1000.")
+    parser.add_option("-f", "--files", dest="files", default=100, type="int",
+                      help="Number of synthetic db files to merge.  Defaults to 100.")
+    parser.add_option("-r", "--rows", dest="rows", default=1000, type="int",
+                      help="Number of rows in each synthetic db file.  Defaults to 1000.")
+    parser.add_option("-y", "--days", dest="days", default=365, type="int",
+                      help="Number of days in the synthetic device history.  Defaults to 365.")
+    parser.add_option("-m", "--megabytes", dest="megabytes", default=16, type="int",
+                      help="Size in megabytes of the synthetic file to decrypt.  Defaults to 16.")
+    (options, args) = parser.parse_args()
+    
+    probe_to_values = dict([(probe, [value]) for probe, value in sample_values.items()])
+    if options.db_file:
+        probe_to_values = sample_values_from_db(options.db_file, probe_to_values.keys())
+    benchmark_flatten(probe_to_values, options.number)
+    print
+    benchmark_merge(options.files, options.rows)
+    print
+    benchmark_data_gaps(options.days)
+    print
+    benchmark_decrypt(options.megabytes)
@@ -20,7 +20,7 @@
 # You should have received a copy of the GNU Lesser General Public
 # License along with Funf. If not, see <http://www.gnu.org/licenses/>.
 # 
-'''Convert a merged sqlite file with json values into separate csv files per probe
+'''Convert a merged sqlite file with json values into separate csv (or parquet) files per probe
 '''
 import os.path
 from optparse import OptionParser
@@ -29,8 +29,15 @@ import simplejson as json
 import csv
 from itertools import product, groupby
 from collections import defaultdict
+import cPickle as pickle
+import tempfile
+import shutil
+from multiprocessing import Pool
+from dbmerge import is_indexed, data_filter, parse_time
+import dbdecrypt
 
-# Two passes, one to figure out the keys for each probe name, the 2nd to fill out the values
+# Two passes, one to figure out the keys for each probe name, the 2nd to fill out the values.
+# The first pass is skipped if the keys are in the schema cache, or folded into the 2nd in single pass mode.
 
 excluded_keys = ("TIMESTAMP", "PROBE")
 def _inner_flatten_values(value, prefix=None):
@@ -80,14 +87,170 @@ def flatten_values(value):
         
     return flat_values
 
-def get_keys(value):
-    return reduce(set.union, [set(fv.keys()) for fv in flatten_values(value)], set())
+def get_keys(value, flatten=flatten_values):
+    return reduce(set.union, [set(fv.keys()) for fv in flatten(value)], set())
+
+
+# Compiled flatteners
+# The values of a probe almost always have the same shape, so the work of walking a value is
+# compiled once into a plan for that shape.  Each compiled function checks the shape of the value 
+# it is given, and raises _ShapeChanged if it differs from the value it was compiled from.
+
+class _ShapeChanged(Exception):
+    pass
+
+_containers = (dict, list)
+_scalar = 'scalar'
+_nested = 'nested'
+
+def _merged(old, new):
+    merged = old.copy()
+    merged.update(new)
+    return merged
+
+def _compile_generic(prefix):
+    return lambda value: _inner_flatten_values(value, prefix=prefix)
+
+def _compile_items(items, prefix):
+    '''Returns a function that flattens the keys of a dict in the order of items, like _inner_flatten_values'''
+    plan = []
+    for key, inner_value in items:
+        new_prefix = ('%s_%s' % (prefix, key)) if prefix else key
+        if isinstance(inner_value, _containers):
+            plan.append((_nested, key, _compile_inner_flatten(inner_value, new_prefix)))
+        else:
+            plan.append((_scalar, key, None if new_prefix in excluded_keys else new_prefix))
+    
+    def flatten_items(value):
+        flat_values = [{}]
+        for kind, key, arg in plan:
+            inner_value = value[key]
+            if kind is _scalar:
+                if isinstance(inner_value, _containers):
+                    raise _ShapeChanged()
+                if arg is not None:
+                    for flat_value in flat_values:
+                        flat_value[arg] = inner_value
+            else:
+                inner_values = arg(inner_value)
+                if len(inner_values) == 1:
+                    for flat_value in flat_values:
+                        flat_value.update(inner_values[0])
+                elif inner_values:
+                    flat_values = [_merged(old, new) for old in flat_values for new in inner_values]
+        return flat_values
+    return flatten_items
+
+def _compile_inner_flatten(value, prefix=None):
+    '''Returns a function that flattens values with the same shape as this one, like _inner_flatten_values'''
+    prefix = prefix or ''
+    if isinstance(value, dict):
+        keys = value.keys()
+        flatten_items = _compile_items(value.items(), prefix)
+        def flatten_dict(value):
+            if not isinstance(value, dict) or value.keys() != keys:
+                raise _ShapeChanged()
+            return flatten_items(value)
+        return flatten_dict
+    elif isinstance(value, list):
+        if not value:
+            # Nothing to learn the shape of the items from yet
+            def flatten_empty_list(value):
+                if not isinstance(value, list) or value:
+                    raise _ShapeChanged()
+                return []
+            return flatten_empty_list
+        flatten_item = _compile_inner_flatten(value[0], prefix)
+        try:
+            for val in value[1:]:
+                flatten_item(val)
+        except _ShapeChanged:
+            # Items have different shapes
+            flatten_item = _compile_generic(prefix)
+        def flatten_list(value):
+            if not isinstance(value, list):
+                raise _ShapeChanged()
+            return [flattened_val for val in value for flattened_val in flatten_item(val)]
+        return flatten_list
+    else:
+        excluded = prefix in excluded_keys
+        def flatten_scalar(value):
+            if isinstance(value, _containers):
+                raise _ShapeChanged()
+            return [{}] if excluded else [{prefix:value}]
+        return flatten_scalar
+
+def compile_flatten_values(value):
+    '''Returns a function that flattens values with the same shape as this one, like flatten_values'''
+    correlated_index_length = len(value['EVENT_TIMESTAMP']) if ('EVENT_TIMESTAMP' in value) else None
+    if not correlated_index_length:
+        flatten_value = _compile_inner_flatten(value)
+        def flatten(value):
+            if 'EVENT_TIMESTAMP' in value and value['EVENT_TIMESTAMP']:
+                raise _ShapeChanged()
+            return flatten_value(value)
+        return flatten
+    
+    keys = value.keys()
+    correlated_keys = sorted([key for key, list_value in value.items() 
+                              if (isinstance(list_value, list) and len(list_value) == correlated_index_length)])
+    uncorrelated_vals = dict([(key,val) for key,val in value.items() if key not in correlated_keys])
+    uncorrelated_keys = uncorrelated_vals.keys()
+    flatten_common = _compile_items(uncorrelated_vals.items(), '')
+    def flatten_correlated(value):
+        if not isinstance(value, dict) or value.keys() != keys:
+            raise _ShapeChanged()
+        correlated_index_length = len(value['EVENT_TIMESTAMP'])
+        if not correlated_index_length:
+            raise _ShapeChanged()
+        correlated_lists = [value[key] for key in correlated_keys]
+        for list_value in correlated_lists:
+            if not isinstance(list_value, list) or len(list_value) != correlated_index_length:
+                raise _ShapeChanged()
+        for key in uncorrelated_keys:
+            list_value = value[key]
+            if isinstance(list_value, list) and len(list_value) == correlated_index_length:
+                raise _ShapeChanged()
+        common_values = flatten_common(value)
+        inner_values = [dict(zip(correlated_keys, vals)) for vals in zip(*correlated_lists)]
+        return [_merged(old, new) for old in common_values for new in inner_values]
+    return flatten_correlated
+
+class ProbeFlattener(object):
+    '''Flattens the values of one probe like flatten_values, using a flattener compiled for the shape of its values.
+
+    The flattener is recompiled when the shape changes, until max_compiles is reached, after which flatten_values is used.'''
+    
+    max_compiles = 8
+    
+    def __init__(self):
+        self.compiles = 0
+        self._flatten = None
+    
+    def __call__(self, value):
+        if self._flatten is not None:
+            try:
+                return self._flatten(value)
+            except _ShapeChanged:
+                self._flatten = None
+        if self.compiles < self.max_compiles:
+            self.compiles += 1
+            self._flatten = compile_flatten_values(value)
+            try:
+                return self._flatten(value)
+            except _ShapeChanged:
+                self._flatten = None
+        return flatten_values(value)
+
+def probe_flatteners():
+    return keydefaultdict(lambda probe: ProbeFlattener())
 
 
 class keydefaultdict(defaultdict):
     def __missing__(self, key):
         try:
-            return self.default_factory(key)
+            value = self[key] = self.default_factory(key)
+            return value
         except TypeError:
             return super(keydefaultdict, self).__missing__(key)
 
@@ -101,83 +264,487 @@ def iterable(some_object):
 
 _select_statement = "select * from data"
 _builtin_probe_prefix = 'edu.mit.media.funf.probe.builtin.'  
+_schema_cache_extension = 'schema.json'
 
-def convert(db_file, out_dir):
-    if not out_dir:
-        raise Exception("Must specify csv destination out_dir")
-    if not os.path.isdir(out_dir):
-        if os.path.exists(out_dir):
-            raise Exception("File already exists at out_dir path.")
-        else:
-            os.makedirs(out_dir)
-      
-    def csv_dict_writer(probe):
-        probe = probe.replace(_builtin_probe_prefix, '', 1)
-        f = open(os.path.join(out_dir, probe) + ".csv", 'w')
-        f.write(u'\ufeff'.encode('utf8')) # BOM (optional...Excel needs it to open UTF-8 file properly)
-        return f
-    
-    conn = sqlite3.connect(db_file)
-    conn.row_factory = sqlite3.Row
-    
+def schema_cache_file(db_file):
+    return db_file + '.' + _schema_cache_extension
+
+def _db_signature(db_file):
+    stat = os.stat(db_file)
+    return [stat.st_size, stat.st_mtime]
+
+def _read_schema_cache_file(db_file):
+    try:
+        with open(schema_cache_file(db_file)) as cache_file:
+            cache = json.load(cache_file)
+    except (IOError, ValueError):
+        return None
+    if cache.get('signature') != _db_signature(db_file):
+        return None
+    return cache
+
+def read_schema_cache(db_file):
+    '''Returns the cached keys for each probe in the db file, or None if there is no cache or the db has changed since'''
+    cache = _read_schema_cache_file(db_file)
+    if cache is None:
+        return None
     probe_to_keys = defaultdict(set)
+    for probe, keys in cache.get('probes', {}).items():
+        probe_to_keys[probe].update(keys)
+    return probe_to_keys
+
+def read_column_types_cache(db_file):
+    '''Returns the cached column types for each probe in the db file, or None if they have not been cached'''
+    cache = _read_schema_cache_file(db_file)
+    return cache.get('types') if cache else None
+
+def write_schema_cache(db_file, probe_to_keys, probe_to_types=None):
+    if probe_to_types is None:
+        # Keep the column types of a previous columnar export
+        cache = _read_schema_cache_file(db_file)
+        probe_to_types = cache.get('types') if cache else None
+    cache = {'signature': _db_signature(db_file),
+             'probes': dict([(probe, sorted(keys)) for probe, keys in probe_to_keys.items()])}
+    if probe_to_types is not None:
+        cache['types'] = probe_to_types
+    try:
+        with open(schema_cache_file(db_file), 'w') as cache_file:
+            json.dump(cache, cache_file)
+    except IOError as e:
+        print "Unable to write schema cache: " + str(e)
+
+def _rows(conn, db_file, statement=_select_statement, parameters=()):
     cursor = conn.cursor()
     try: 
-        cursor.execute(_select_statement)
+        cursor.execute(statement, parameters)
     except (sqlite3.OperationalError,sqlite3.DatabaseError):
         raise Exception("Unable to parse file: " + db_file)
     else:
         try:
             for row in cursor:
                 _id, device, probe, timestamp, value = row
-                value_dict = json.loads(value)
-                probe_to_keys[probe].update(get_keys(value_dict))
+                yield _id, device, probe, timestamp, value
         except IndexError:
             raise Exception("No file info exists in: " + db_file)
-    
-    
-    probe_to_files = keydefaultdict(csv_dict_writer)
-    probe_to_writers = {}
-    
-    cursor = conn.cursor()
-    try: 
-        cursor.execute(_select_statement)
+
+def _data_rows(conn, db_file, where='', parameters=()):
+    '''Returns the rows matching a where clause from data_filter, in table order, so that other rows are never decoded'''
+    if not where:
+        return _rows(conn, db_file)
+    if is_indexed(conn):
+        return _rows(conn, db_file, "%s where %s order by rowid" % (_indexed_select_statement, where), parameters)
+    return _rows(conn, db_file, "%s where %s" % (_select_statement, where), parameters)
+
+def _csv_rows(row_values, _id, device, timestamp):
+    '''Adds the basic info to each flattened row, and encodes strings for the csv writer'''
+    basic_info = {"id": _id, "device": device, "timestamp": timestamp}
+    for row in row_values:
+        row.update(basic_info)
+        for k,v in row.items():
+            if isinstance(v, str) or isinstance(v, unicode):
+                row[k] = v.encode('utf8')
+    return row_values
+
+def _csv_fieldnames(keys):
+    return ["id", "device", "timestamp"] + sorted(keys)
+
+def _csv_name(probe):
+    return probe.replace(_builtin_probe_prefix, '', 1)
+
+def _open_csv_file(out_dir, probe):
+    f = open(os.path.join(out_dir, _csv_name(probe)) + ".csv", 'w')
+    f.write(u'\ufeff'.encode('utf8')) # BOM (optional...Excel needs it to open UTF-8 file properly)
+    return f
+
+def _convert_single_pass(rows, probe_to_files, spill_dir):
+    '''Flattens each row once, spilling the rows of each probe to a temp file while its keys are discovered.
+
+    The csv files are written from the spill files once all of the keys are known.'''
+    probe_to_keys = defaultdict(set)
+    probe_to_spills = keydefaultdict(lambda probe: tempfile.TemporaryFile(dir=spill_dir))
+    flatteners = probe_flatteners()
+    try:
+        for _id, device, probe, timestamp, value in rows:
+            keys = probe_to_keys[probe]
+            spill = probe_to_spills[probe]
+            row_values = flatteners[probe](json.loads(value))
+            for row in row_values:
+                keys.update(row.iterkeys())
+            for row in _csv_rows(row_values, _id, device, timestamp):
+                pickle.dump(row, spill, pickle.HIGHEST_PROTOCOL)
+        
+        for probe, spill in probe_to_spills.items():
+            writer = csv.DictWriter(probe_to_files[probe], fieldnames=_csv_fieldnames(probe_to_keys[probe]))
+            writer.writeheader()
+            spill.seek(0)
+            while True:
+                try:
+                    writer.writerow(pickle.load(spill))
+                except EOFError:
+                    break
+    finally:
+        for spill in probe_to_spills.values():
+            spill.close()
+    return probe_to_keys
+
+_rowid_range_statement = "select * from data where rowid between ? and ?"
+# The data view of an indexed merged file has no rowid, so ranges are taken from its table
+_indexed_select_statement = '''select id, (select name from devices where devices.id = device), (select name from probes where probes.id = probe), 
+                                timestamp, value from data_values'''
+_indexed_rowid_range_statement = _indexed_select_statement + " where rowid between ? and ?"
+_rows_per_chunk = 50000
+_copy_buffer_size = 1024 * 1024
+
+def _rowid_ranges(conn, db_file, rows_per_chunk=_rows_per_chunk):
+    '''Splits the data table into consecutive rowid ranges, in table order'''
+    table = 'data_values' if is_indexed(conn) else 'data'
+    try:
+        first, last = conn.execute("select (select min(rowid) from %s), (select max(rowid) from %s)" % (table, table)).fetchone()
     except (sqlite3.OperationalError,sqlite3.DatabaseError):
         raise Exception("Unable to parse file: " + db_file)
-    else:
-        try:
-            for row in cursor:
-                _id, device, probe, timestamp, value = row
+    if first is None:
+        return []
+    return [(start, min(start + rows_per_chunk - 1, last)) for start in xrange(first, last + 1, rows_per_chunk)]
+
+def _chunk_part_file(part_dir, probe, start):
+    return os.path.join(part_dir, '%s.%d' % (_csv_name(probe), start))
+
+def _chunk_rows(conn, db_file, start, end, where='', parameters=()):
+    statement = _indexed_rowid_range_statement if is_indexed(conn) else _rowid_range_statement
+    if where:
+        statement = "%s and %s order by rowid" % (statement, where)
+    return _rows(conn, db_file, statement, [start, end] + list(parameters))
+
+def _chunk_keys(task):
+    db_file, start, end, where, parameters = task
+    conn = sqlite3.connect(db_file)
+    probe_to_keys = defaultdict(set)
+    flatteners = probe_flatteners()
+    for _id, device, probe, timestamp, value in _chunk_rows(conn, db_file, start, end, where, parameters):
+        probe_to_keys[probe].update(get_keys(json.loads(value), flatteners[probe]))
+    conn.close()
+    return dict(probe_to_keys)
+
+def _chunk_export(task):
+    '''Writes the rows of one rowid range to a part file per probe.
+
+    Rows are written as csv if the keys of each probe are known, otherwise they are spilled and their keys returned.'''
+    db_file, part_dir, start, end, probe_to_keys, where, parameters = task
+    conn = sqlite3.connect(db_file)
+    chunk_probe_to_keys = defaultdict(set)
+    probe_to_parts = keydefaultdict(lambda probe: open(_chunk_part_file(part_dir, probe, start), 'wb'))
+    probe_to_writers = {}
+    flatteners = probe_flatteners()
+    try:
+        for _id, device, probe, timestamp, value in _chunk_rows(conn, db_file, start, end, where, parameters):
+            part = probe_to_parts[probe]
+            row_values = flatteners[probe](json.loads(value))
+            if probe_to_keys is None:
+                keys = chunk_probe_to_keys[probe]
+                for row in row_values:
+                    keys.update(row.iterkeys())
+                for row in _csv_rows(row_values, _id, device, timestamp):
+                    pickle.dump(row, part, pickle.HIGHEST_PROTOCOL)
+            else:
                 writer = probe_to_writers.get(probe)
                 if not writer:
-                    writer = csv.DictWriter(probe_to_files[probe], fieldnames=(["id", "device", "timestamp"] + sorted(probe_to_keys[probe])))
-                    writer.writeheader()
+                    writer = csv.DictWriter(part, fieldnames=_csv_fieldnames(probe_to_keys[probe]))
                     probe_to_writers[probe] = writer
-                basic_info = {"id": _id, "device": device, "timestamp": timestamp}
+                writer.writerows(_csv_rows(row_values, _id, device, timestamp))
+    finally:
+        for part in probe_to_parts.values():
+            part.close()
+        conn.close()
+    return start, probe_to_parts.keys(), dict(chunk_probe_to_keys)
+
+def _spilled_part_to_csv(task):
+    part_file, fieldnames = task
+    with open(part_file, 'rb') as spill:
+        with open(part_file + '.csv', 'wb') as part:
+            writer = csv.DictWriter(part, fieldnames=fieldnames)
+            while True:
+                try:
+                    writer.writerow(pickle.load(spill))
+                except EOFError:
+                    break
+    shutil.move(part_file + '.csv', part_file)
+
+def _convert_parallel(db_file, out_dir, probe_to_keys, jobs, single_pass=False, filters=None):
+    '''Splits the data table into rowid ranges and exports them on a pool of worker processes.
+
+    Each worker writes a part file per probe, which are concatenated in rowid order so the rows keep the order of a serial export.'''
+    conn = sqlite3.connect(db_file)
+    chunks = _rowid_ranges(conn, db_file)
+    where, parameters = data_filter(conn, **(filters or {}))
+    conn.close()
+    
+    pool = Pool(jobs)
+    part_dir = tempfile.mkdtemp(dir=out_dir)
+    try:
+        if probe_to_keys is None and not single_pass:
+            probe_to_keys = defaultdict(set)
+            for chunk_probe_to_keys in pool.imap(_chunk_keys, [(db_file, start, end, where, parameters) for start, end in chunks]):
+                for probe, keys in chunk_probe_to_keys.items():
+                    probe_to_keys[probe].update(keys)
+        
+        spilled = probe_to_keys is None
+        results = pool.map(_chunk_export, [(db_file, part_dir, start, end, probe_to_keys, where, parameters) for start, end in chunks])
+        if spilled:
+            probe_to_keys = defaultdict(set)
+            for start, probes, chunk_probe_to_keys in results:
+                for probe, keys in chunk_probe_to_keys.items():
+                    probe_to_keys[probe].update(keys)
+            pool.map(_spilled_part_to_csv, [(_chunk_part_file(part_dir, probe, start), _csv_fieldnames(probe_to_keys[probe]))
+                                            for start, probes, chunk_probe_to_keys in results for probe in probes])
+        pool.close()
+        
+        probe_to_parts = defaultdict(list)
+        for start, probes, chunk_probe_to_keys in sorted(results):
+            for probe in probes:
+                probe_to_parts[probe].append(_chunk_part_file(part_dir, probe, start))
+        for probe, part_files in probe_to_parts.items():
+            with _open_csv_file(out_dir, probe) as csv_file:
+                csv.DictWriter(csv_file, fieldnames=_csv_fieldnames(probe_to_keys[probe])).writeheader()
+                for part_file in part_files:
+                    with open(part_file, 'rb') as part:
+                        shutil.copyfileobj(part, csv_file, _copy_buffer_size)
+                    os.remove(part_file)
+    finally:
+        pool.terminate()
+        pool.join()
+        shutil.rmtree(part_dir, ignore_errors=True)
+    return probe_to_keys
+
+def convert(db_file, out_dir, single_pass=False, use_schema_cache=True, jobs=1, output_format='csv', keys=None, 
+            probes=(), devices=(), since=None, until=None):
+    '''Exports the data of a merged db file, or only the rows of the probes and devices, with a timestamp from since until before until.
+    The schema cache is not written for a filtered export, which may not have all the keys.'''
+    filters = {'probes': probes, 'devices': devices, 'since': since, 'until': until}
+    filtered = bool(probes or devices or since is not None or until is not None)
+    if not out_dir:
+        raise Exception("Must specify csv destination out_dir")
+    if not os.path.isdir(out_dir):
+        if os.path.exists(out_dir):
+            raise Exception("File already exists at out_dir path.")
+        else:
+            os.makedirs(out_dir)
+    if output_format == 'parquet':
+        return convert_to_parquet(db_file, out_dir, use_schema_cache, keys=keys, **filters)
+    elif output_format != 'csv':
+        raise Exception("Unknown output format: %s" % output_format)
+      
+    def csv_dict_writer(probe):
+        return _open_csv_file(out_dir, probe)
+    
+    probe_to_keys = read_schema_cache(db_file) if use_schema_cache else None
+    if jobs > 1 and keys and not dbdecrypt.is_funf_database(db_file):
+        print "Exporting encrypted file %s on one process" % db_file
+        jobs = 1
+    if jobs > 1:
+        probe_to_keys = _convert_parallel(db_file, out_dir, probe_to_keys, jobs, single_pass, filters)
+        if use_schema_cache and not filtered:
+            write_schema_cache(db_file, probe_to_keys)
+        return
+    
+    conn = dbdecrypt.connect(db_file, keys)
+    conn.row_factory = sqlite3.Row
+    where, parameters = data_filter(conn, **filters)
+    probe_to_files = keydefaultdict(csv_dict_writer)
+    flatteners = probe_flatteners()
+    
+    if probe_to_keys is None and single_pass:
+        probe_to_keys = _convert_single_pass(_data_rows(conn, db_file, where, parameters), probe_to_files, out_dir)
+    else:
+        if probe_to_keys is None:
+            probe_to_keys = defaultdict(set)
+            for _id, device, probe, timestamp, value in _data_rows(conn, db_file, where, parameters):
                 value_dict = json.loads(value)
-                row_values = flatten_values(value_dict)
-                for row in row_values:
-                    row.update(basic_info)
-                    for k,v in row.items():
-                        if isinstance(v, str) or isinstance(v, unicode):
-                            row[k] = v.encode('utf8')
-                writer.writerows(row_values)
-        except IndexError:
-            raise Exception("No file info exists in: " + db_file)
+                probe_to_keys[probe].update(get_keys(value_dict, flatteners[probe]))
+        
+        probe_to_writers = {}
+        for _id, device, probe, timestamp, value in _data_rows(conn, db_file, where, parameters):
+            writer = probe_to_writers.get(probe)
+            if not writer:
+                writer = csv.DictWriter(probe_to_files[probe], fieldnames=_csv_fieldnames(probe_to_keys[probe]))
+                writer.writeheader()
+                probe_to_writers[probe] = writer
+            value_dict = json.loads(value)
+            writer.writerows(_csv_rows(flatteners[probe](value_dict), _id, device, timestamp))
+    conn.close()
     
     for f in probe_to_files.values():
         f.close()
+    
+    if use_schema_cache and not filtered:
+        write_schema_cache(db_file, probe_to_keys)
+
+# Columnar export
+# Each probe is written to a parquet file with a typed column per key, one row group at a time.
+
+_formats = ('csv', 'parquet')
+_basic_column_types = (("id", 'string'), ("device", 'string'), ("timestamp", 'int64'))
+_numeric_column_types = ('bool', 'int64', 'float64')
+_rows_per_row_group = 50000
+
+def _column_type(value):
+    if value is None:
+        return None
+    elif isinstance(value, bool):
+        return 'bool'
+    elif isinstance(value, (int, long)):
+        return 'int64'
+    elif isinstance(value, float):
+        return 'float64'
+    else:
+        return 'string'
+
+def _merged_column_type(column_type, other_type):
+    if column_type is None or column_type == other_type:
+        return other_type
+    elif other_type is None:
+        return column_type
+    elif column_type in _numeric_column_types and other_type in _numeric_column_types:
+        return max(column_type, other_type, key=_numeric_column_types.index)
+    else:
+        return 'string'
+
+def get_column_types(conn, db_file, flatteners, where='', parameters=()):
+    '''Returns the type of each flattened key of each probe, along with the types of the basic columns'''
+    probe_to_types = defaultdict(dict)
+    for _id, device, probe, timestamp, value in _data_rows(conn, db_file, where, parameters):
+        column_types = probe_to_types[probe]
+        column_types['timestamp'] = _merged_column_type(column_types.get('timestamp'), _column_type(timestamp))
+        for row in flatteners[probe](json.loads(value)):
+            for key, val in row.iteritems():
+                column_types[key] = _merged_column_type(column_types.get(key), _column_type(val))
+    return probe_to_types
+
+def _parquet_columns(column_types):
+    '''Returns the (name, type) of each column, with the basic columns first, and keys of unknown type as strings'''
+    basic_columns = [(name, column_types.get(name) or column_type) for name, column_type in _basic_column_types]
+    keys = sorted(key for key in column_types if key not in dict(_basic_column_types))
+    return basic_columns + [(key, column_types[key] or 'string') for key in keys]
+
+_arrow_types = {
+    'bool': 'bool_',
+    'int64': 'int64',
+    'float64': 'float64',
+    'string': 'string',
+}
+
+_column_converters = {
+    'bool': bool,
+    'int64': int,
+    'float64': float,
+    'string': lambda value: value if isinstance(value, unicode) else unicode(value),
+}
+
+class _ParquetProbeWriter(object):
+    '''Buffers the rows of one probe by column, and writes them to a parquet file a row group at a time'''
+    
+    def __init__(self, file_name, columns, row_group_size=_rows_per_row_group):
+        import pyarrow
+        import pyarrow.parquet
+        self._pyarrow = pyarrow
+        self.columns = columns
+        self.schema = pyarrow.schema([pyarrow.field(name, getattr(pyarrow, _arrow_types[column_type])()) for name, column_type in columns])
+        self.row_group_size = row_group_size
+        self._converters = [_column_converters[column_type] for name, column_type in columns]
+        self._buffers = [[] for column in columns]
+        self._writer = pyarrow.parquet.ParquetWriter(file_name, self.schema)
+    
+    def writerows(self, rows):
+        for row in rows:
+            for (name, column_type), convert, buffer in zip(self.columns, self._converters, self._buffers):
+                value = row.get(name)
+                buffer.append(None if value is None else convert(value))
+        if len(self._buffers[0]) >= self.row_group_size:
+            self.flush()
+    
+    def flush(self):
+        if self._buffers[0]:
+            arrays = [self._pyarrow.array(buffer, type=field.type) for buffer, field in zip(self._buffers, self.schema)]
+            self._writer.write_table(self._pyarrow.Table.from_arrays(arrays, schema=self.schema))
+            self._buffers = [[] for column in self.columns]
+    
+    def close(self):
+        self.flush()
+        self._writer.close()
+
+def convert_to_parquet(db_file, out_dir, use_schema_cache=True, row_group_size=_rows_per_row_group, keys=None, 
+                       probes=(), devices=(), since=None, until=None):
+    '''Writes the data of each probe to a parquet file, with typed columns for the basic info and flattened keys'''
+    try:
+        import pyarrow.parquet
+    except ImportError:
+        raise Exception("The parquet format requires pyarrow (https://arrow.apache.org/docs/python/)")
+    
+    conn = dbdecrypt.connect(db_file, keys)
+    where, parameters = data_filter(conn, probes, devices, since, until)
+    flatteners = probe_flatteners()
+    probe_to_types = read_column_types_cache(db_file) if use_schema_cache else None
+    if probe_to_types is None:
+        probe_to_types = get_column_types(conn, db_file, flatteners, where, parameters)
+    
+    def parquet_writer(probe):
+        file_name = os.path.join(out_dir, _csv_name(probe)) + ".parquet"
+        return _ParquetProbeWriter(file_name, _parquet_columns(probe_to_types[probe]), row_group_size)
+    probe_to_writers = keydefaultdict(parquet_writer)
+    try:
+        for _id, device, probe, timestamp, value in _data_rows(conn, db_file, where, parameters):
+            basic_info = {"id": _id, "device": device, "timestamp": timestamp}
+            row_values = flatteners[probe](json.loads(value))
+            for row in row_values:
+                row.update(basic_info)
+            probe_to_writers[probe].writerows(row_values)
+    finally:
+        for writer in probe_to_writers.values():
+            writer.close()
+        conn.close()
+    
+    if use_schema_cache and not where:
+        probe_to_keys = dict([(probe, set(column_types) - set(dict(_basic_column_types))) for probe, column_types in probe_to_types.items()])
+        write_schema_cache(db_file, probe_to_keys, probe_to_types)
 
 if __name__ == '__main__':
     usage = "%prog [options] [sqlite_file1.db [sqlite_file2.db...]]"
     description = __doc__
     parser = OptionParser(usage="%s\n\n%s" % (usage, description))
     parser.add_option("-o", "--output", dest="output_dir", default=os.curdir,
-                      help="Directory write csv files.  Defaults to current directory.", metavar="FILE")
+                      help="Directory to write output files.  Defaults to current directory.", metavar="FILE")
+    parser.add_option("-s", "--single-pass", dest="single_pass", default=False,
+                      action="store_true",
+                      help="Read and flatten the data only once, spilling rows to temp files in the output directory until the columns are known.")
+    parser.add_option("-c", "--no-schema-cache", dest="use_schema_cache", default=True,
+                      action="store_false",
+                      help="Do not read or write the '.%s' file of probe keys kept next to each db file." % _schema_cache_extension)
+    parser.add_option("-j", "--jobs", dest="jobs", default=1, type="int",
+                      help="Number of worker processes used to parse and flatten the data.  Defaults to 1.")
+    parser.add_option("-f", "--format", dest="output_format", default='csv', type="choice", choices=_formats,
+                      help="Output file format, one of %s.  The parquet format requires pyarrow, and ignores --single-pass and --jobs.  Defaults to csv." % ', '.join(_formats))
+    parser.add_option("-k", "--key", dest="keys", default=[], action="append",
+                      help="A DES key to read encrypted db files with, decrypting them in memory instead of on disk.  Can be given more than once.")
+    parser.add_option("--password", dest="passwords", default=[], action="append",
+                      help="A password to derive a DES key to read encrypted db files with from.  Can be given more than once.")
+    parser.add_option("--password-file", dest="password_file", default=None, metavar="FILE",
+                      help="A file of passwords to derive DES keys to read encrypted db files with from, one per line.")
+    parser.add_option("-p", "--probe", dest="probes", default=[], action="append",
+                      help="Only export the data of this probe.  Use the full class name, unless builtin probe.  Can be given more than once.")
+    parser.add_option("-d", "--device", dest="devices", default=[], action="append",
+                      help="Only export the data of this device.  Use the full device UUID.  Can be given more than once.")
+    parser.add_option("--since", dest="since", default=None,
+                      help="Only export data from this time, in seconds since the epoch or as a local YYYY-MM-DD [HH:MM[:SS]].")
+    parser.add_option("--until", dest="until", default=None,
+                      help="Only export data from before this time, in seconds since the epoch or as a local YYYY-MM-DD [HH:MM[:SS]].")
     (options, args) = parser.parse_args()
     try:
+        keys = dbdecrypt.load_keys(options.keys, options.passwords, options.password_file)
+        probes = [probe if "." in probe else _builtin_probe_prefix + probe for probe in options.probes]
+        since = parse_time(options.since) if options.since else None
+        until = parse_time(options.until) if options.until else None
         for file_name in args:
-            convert(file_name, options.output_dir)
+            convert(file_name, options.output_dir, options.single_pass, options.use_schema_cache, options.jobs, options.output_format, keys,
+                    probes, options.devices, since, until)
     except Exception as e:
         import sys
         sys.exit("ERROR: " + str(e))
\ No newline at end of file
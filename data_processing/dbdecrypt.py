@@ -24,29 +24,158 @@
 '''Decrypt one or more sqlite3 files using the provided key.  Checks to see if it is readable
 '''
 from optparse import OptionParser
+from multiprocessing import Pool
+from itertools import imap
+from cStringIO import StringIO
 import decrypt
+import dbsalvage
 import sqlite3
 import shutil
+import os.path
+import struct
+import time
 
-_random_table_name = 'jioanewvoiandoasdjf'
-def is_funf_database(file_name):
+_header_size = 100
+_page_sizes = set([1] + [2 ** i for i in range(9, 16)]) # 1 stands for 65536
+
+def has_sqlite_header(file_name):
+    '''Returns whether the file starts with a sqlite header, reading only the header.  Empty files are sqlite databases too.'''
+    with open(file_name, 'rb') as db_file:
+        header = db_file.read(_header_size)
+    if not header:
+        return True
+    return (len(header) == _header_size
+            and header.startswith(decrypt.sqlite_header)
+            and struct.unpack('>H', header[16:18])[0] in _page_sizes
+            and header[18] in '\x01\x02' and header[19] in '\x01\x02'
+            and header[21:24] == '\x40\x20\x20')
+
+def is_funf_database(file_name, quick_check=False):
+    '''Returns whether the file is a sqlite database, and passes sqlite's quick_check if quick_check is True.  Never writes to the file.'''
+    try:
+        if not has_sqlite_header(file_name):
+            return False
+    except IOError:
+        return False
+    if not quick_check:
+        return True
+    conn = None
     try:
         conn = sqlite3.connect(file_name)
-        conn.execute('create table %s (nothing text)' % _random_table_name)
-        conn.execute('drop table %s' % _random_table_name)
+        conn.execute('pragma query_only = 1')
+        return conn.execute('pragma quick_check').fetchone()[0] == 'ok'
     except (sqlite3.OperationalError, sqlite3.DatabaseError):
         return False
-    else:
-        return True
     finally:
         if conn is not None: conn.close()
 
+def find_files(paths, extension=None):
+    '''Returns the files given, and the files in the directories given, leaving out backups of encrypted files'''
+    backup_extension = '.' + (extension or decrypt.default_extension)
+    file_names = []
+    for path in paths:
+        if os.path.isdir(path):
+            for dir_path, dir_names, names in os.walk(path):
+                dir_names.sort()
+                file_names.extend([os.path.join(dir_path, name) for name in sorted(names) if not name.endswith(backup_extension)])
+        else:
+            file_names.append(path)
+    return file_names
+
+def _check_task(task):
+    file_name, quick_check = task
+    return file_name, is_funf_database(file_name, quick_check)
+
+def check_files(file_names, jobs=1, quick_check=False):
+    '''Prints whether each file is a sqlite database, reading them on jobs processes, and a summary.
+    Returns the files that are not.'''
+    tasks = [(file_name, quick_check) for file_name in file_names]
+    start = time.time()
+    if jobs > 1:
+        pool = Pool(jobs)
+        results = pool.imap_unordered(_check_task, tasks, max(1, min(256, len(tasks) / (jobs * 4))))
+    else:
+        pool = None
+        results = imap(_check_task, tasks)
+    
+    not_databases = []
+    for file_name, is_database in results:
+        print "%s: %s" % (file_name, "database" if is_database else "NOT a database")
+        if not is_database:
+            not_databases.append(file_name)
+    if pool is not None:
+        pool.close()
+        pool.join()
+    
+    seconds = max(time.time() - start, 1e-6)
+    print "Checked %d files in %.2f seconds, %.1f files/sec, %d are not databases" % (len(tasks), seconds, len(tasks) / seconds, len(not_databases))
+    return not_databases
+
+def key_ring(key):
+    '''Returns the keys to try, given a key or a list of keys'''
+    return key if isinstance(key, (list, tuple)) else [key]
+
+def load_keys(keys=(), passwords=(), password_file=None):
+    '''Returns the keys, followed by the keys derived from the passwords and from the passwords in password_file, one per line'''
+    passwords = list(passwords)
+    if password_file:
+        with open(password_file) as passwords_file:
+            passwords.extend([line.rstrip('\r\n') for line in passwords_file if line.rstrip('\r\n')])
+    return list(keys) + [decrypt.key_from_password(password) for password in passwords]
+
+# Encrypted files can be read without decrypting them on disk.  They are decrypted in memory, 
+# and their tables are read from the decrypted pages into an in memory database, skipping pages that can not be read.
+
+def _load_encrypted(conn, file_name, keys, schema='main'):
+    key = decrypt.find_key(file_name, key_ring(keys))
+    if key is None:
+        raise sqlite3.DatabaseError("No key decrypts %s to a sqlite3 db file" % file_name)
+    try:
+        contents = decrypt.decrypt_contents(file_name, key)
+    except (IOError, ValueError) as e:
+        raise sqlite3.DatabaseError("Unable to decrypt %s: %s" % (file_name, e))
+    reader = dbsalvage.PageReader(StringIO(contents))
+    try:
+        dbsalvage.copy_tables(reader, conn, schema)
+    finally:
+        reader.close()
+
+def connect(file_name, keys=None):
+    '''Opens a db file, or if it is encrypted and keys are given, an in memory copy of it decrypted with the key that matches it'''
+    if not keys or is_funf_database(file_name):
+        return sqlite3.connect(file_name)
+    conn = sqlite3.connect(':memory:')
+    try:
+        _load_encrypted(conn, file_name, keys)
+    except:
+        conn.close()
+        raise
+    return conn
+
+def attach(conn, file_name, schema, keys=None):
+    '''Attaches a db file to the connection as schema, or if it is encrypted and keys are given, an in memory copy of it decrypted with the key that matches it'''
+    if not keys or is_funf_database(file_name):
+        conn.execute("attach database ? as %s" % schema, (file_name,))
+        return
+    conn.execute("attach database ':memory:' as %s" % schema)
+    try:
+        _load_encrypted(conn, file_name, keys, schema)
+    except:
+        conn.execute("detach database %s" % schema)
+        raise
+
 def decrypt_if_not_db_file(file_name, key, extension=None):
+    '''Decrypts the file if it is not a db file, with the key, or the one in a list of keys that decrypts the sqlite header'''
     if is_funf_database(file_name):
         print "Already decrypted: '%s'" % file_name
         return True
     else:
         print ("Attempting to decrypt: '%s'..." % file_name),
+        key = decrypt.find_key(file_name, key_ring(key))
+        if key is None:
+            print "FAILED!!!!"
+            print "No key decrypts the file to a sqlite3 db file, leaving it alone."
+            return False
         decrypt.decrypt([file_name], key, extension)
         if is_funf_database(file_name):
             print "Success!"
@@ -58,20 +187,85 @@ def decrypt_if_not_db_file(file_name, key, extension=None):
             shutil.move(decrypt.backup_file(file_name, extension), file_name)
             return False
 
+def _decrypt_task(task):
+    '''Returns the file, its size, whether it is a db file after decrypting it if needed, and what was done'''
+    file_name, key, extension = task
+    try:
+        size = os.path.getsize(file_name)
+        if is_funf_database(file_name):
+            return file_name, size, True, "Already decrypted"
+        key = decrypt.find_key(file_name, key_ring(key))
+        if key is None:
+            return file_name, size, False, "FAILED, no key decrypts the file to a sqlite3 db file.  Leaving it alone."
+        decrypt.decrypt([file_name], key, extension)
+        if is_funf_database(file_name):
+            return file_name, size, True, "Decrypted"
+        shutil.move(decrypt.backup_file(file_name, extension), file_name)
+        return file_name, size, False, "FAILED, encrypted with another method or key, or not a valid sqlite3 db file.  Keeping original file."
+    except Exception as e:
+        return file_name, 0, False, "FAILED, " + str(e)
+
+def decrypt_files(file_names, key, extension=None, jobs=1):
+    '''Decrypts the files that are not db files, with the key or list of keys, on jobs processes, and prints the result for each file and a summary.
+    Returns the files that could not be decrypted.'''
+    tasks = [(file_name, key, extension) for file_name in file_names]
+    start = time.time()
+    if jobs > 1:
+        pool = Pool(jobs)
+        results = pool.imap_unordered(_decrypt_task, tasks, max(1, min(64, len(tasks) / (jobs * 4))))
+    else:
+        pool = None
+        results = imap(_decrypt_task, tasks)
+    
+    total_size = 0
+    failed = []
+    for file_name, size, success, message in results:
+        print "%s: %s" % (file_name, message)
+        total_size += size
+        if not success:
+            failed.append(file_name)
+    if pool is not None:
+        pool.close()
+        pool.join()
+    
+    seconds = max(time.time() - start, 1e-6)
+    print "Checked %d files (%.1f MB) in %.2f seconds, %.1f files/sec, %.1f MB/sec" % (
+        len(tasks), total_size / 1048576.0, seconds, len(tasks) / seconds, total_size / 1048576.0 / seconds)
+    if failed:
+        print "Failed to decrypt %d files:" % len(failed)
+        for file_name in sorted(failed):
+            print "\t" + file_name
+    return failed
+
 if __name__ == '__main__':
-    usage = "%prog [options] [sqlite_file1.db [sqlite_file2.db...]]"
-    description = "Safely decrypt Sqlite3 db files.  Checks to see if the file can be opened by Sqlite.  If so, the file is left alone, otherwise the file is decrypted.  Uses the decrypt script, so it always keeps a backup of the original encrypted files. "
+    usage = "%prog [options] [sqlite_file1.db|directory [sqlite_file2.db|directory...]]"
+    description = "Safely decrypt Sqlite3 db files.  Checks to see if the file starts with a Sqlite header.  If so, the file is left alone, otherwise the file is decrypted.  Uses the decrypt script, so it always keeps a backup of the original encrypted files. "
     parser = OptionParser(usage="%s\n\n%s" % (usage, description))
     parser.add_option("-i", "--inplace", dest="extension", default=None,
                       help="The extension to rename the original file to.  Will not overwrite file if it already exists. Defaults to '%s'." % decrypt.default_extension,)
-    parser.add_option("-k", "--key", dest="key", default=None,
-                      help="The DES key used to decrypt the files.  Uses the default hard coded one if one is not supplied.",)
+    parser.add_option("-k", "--key", dest="keys", default=[], action="append",
+                      help="A DES key to decrypt the files with.  Can be given more than once.  Prompts for a password if no keys or passwords are supplied.",)
+    parser.add_option("-p", "--password", dest="passwords", default=[], action="append",
+                      help="A password to derive a DES key from.  Can be given more than once.")
+    parser.add_option("-P", "--password-file", dest="password_file", default=None, metavar="FILE",
+                      help="A file of passwords to derive DES keys from, one per line.")
+    parser.add_option("-j", "--jobs", dest="jobs", default=1, type="int",
+                      help="Number of worker processes to check and decrypt files on.  Defaults to 1.")
+    parser.add_option("-c", "--check", dest="check", action="store_true", default=False,
+                      help="Only report which files are sqlite databases, without decrypting them.")
+    parser.add_option("-q", "--quick-check", dest="quick_check", action="store_true", default=False,
+                      help="With --check, also run sqlite's quick_check on files with a sqlite header.")
     (options, args) = parser.parse_args()
-    key = options.key if options.key else decrypt.key_from_password(decrypt.prompt_for_password())
-    
-    try:
-        for file_name in args:
-            decrypt_if_not_db_file(file_name, key, options.extension)
-    except Exception as e:
-        import sys
-        sys.exit("ERROR: " + str(e))
\ No newline at end of file
+    file_names = find_files(args, options.extension)
+    if options.check:
+        check_files(file_names, options.jobs, options.quick_check)
+    else:
+        keys = load_keys(options.keys, options.passwords, options.password_file)
+        if not keys:
+            keys = [decrypt.key_from_password(decrypt.prompt_for_password())]
+        
+        try:
+            decrypt_files(file_names, keys, options.extension, options.jobs)
+        except Exception as e:
+            import sys
+            sys.exit("ERROR: " + str(e))
\ No newline at end of file
@@ -27,12 +27,246 @@ import sqlite3
 from optparse import OptionParser
 import os.path
 import time
+import hashlib
+from itertools import imap
+from multiprocessing import Pool
 from dbsalvage import salvage
+import dbdecrypt
 
 file_info_table = 'file_info'
 data_table = 'data'
+manifest_table = 'merged_files'
 
-def merge(db_files=None, out_file=None, overwrite=False, attempt_salvage=True):
+# The indexed schema stores device and probe names once, in lookup tables, and keys the rows by their integer ids.
+# The data view and its insert trigger keep the same columns, row order and inserts as the data table of the plain schema.
+values_table = 'data_values'
+_plain_schema = (
+    'create table if not exists data (id text, device text, probe text, timestamp long, value text)',
+)
+_indexed_schema = (
+    'create table if not exists devices (id integer primary key, name text unique)',
+    'create table if not exists probes (id integer primary key, name text unique)',
+    'create table if not exists data_values (id text, device integer, probe integer, timestamp long, value text)',
+    '''create view if not exists data as select data_values.id as id, 
+        (select name from devices where devices.id = data_values.device) as device, 
+        (select name from probes where probes.id = data_values.probe) as probe, 
+        data_values.timestamp as timestamp, data_values.value as value from data_values''',
+    '''create trigger if not exists data_insert instead of insert on data begin
+        insert or ignore into devices (name) values (new.device);
+        insert or ignore into probes (name) values (new.probe);
+        insert into data_values values (new.id, (select id from devices where name = new.device), (select id from probes where name = new.probe), new.timestamp, new.value);
+    end''',
+)
+# Created once the data is loaded
+_indexed_schema_indexes = (
+    'create index if not exists data_values_device_probe_timestamp on data_values (device, probe, timestamp)',
+)
+
+def is_indexed(conn):
+    '''Returns True if the merged db has the indexed schema'''
+    row = conn.execute("select type from sqlite_master where name=?", (data_table,)).fetchone()
+    return row is not None and row[0] == 'view'
+
+def data_filter(conn, probes=(), devices=(), since=None, until=None):
+    '''Returns a where clause, or '' for all rows, and its parameters, that selects the rows of the probes and devices
+    with a timestamp from since until before until, from the data table of a plain merged file or the data_values table of an indexed one.'''
+    indexed = is_indexed(conn)
+    clauses = []
+    parameters = []
+    for column, names in (('device', devices), ('probe', probes)):
+        if names:
+            slots = ', '.join(['?'] * len(names))
+            clauses.append("%s in (select id from %ss where name in (%s))" % (column, column, slots) if indexed else "%s in (%s)" % (column, slots))
+            parameters.extend(names)
+    if since is not None:
+        clauses.append("timestamp >= ?")
+        parameters.append(since)
+    if until is not None:
+        clauses.append("timestamp < ?")
+        parameters.append(until)
+    return ' and '.join(clauses), parameters
+
+_time_formats = ('%Y-%m-%d', '%Y-%m-%d %H:%M', '%Y-%m-%d %H:%M:%S', '%Y-%m-%dT%H:%M:%S')
+
+def parse_time(value):
+    '''Returns the unix time of a number of seconds, or of a local date and time such as 2011-09-16 or 2011-09-16 14:30'''
+    try:
+        return int(value)
+    except ValueError:
+        pass
+    for time_format in _time_formats:
+        try:
+            return int(time.mktime(time.strptime(value, time_format)))
+        except ValueError:
+            pass
+    raise Exception("Unable to parse time '%s', use seconds since the epoch or YYYY-MM-DD [HH:MM[:SS]]" % value)
+
+# Settings for building the merged file.  Syncing is only turned off when writing a new file, which can be merged again if the merge is interrupted;
+# an existing file being added to keeps syncing at the end of each WAL transaction, so rows merged before are not at risk.
+# Synchronous is a setting of the connection, so only the journal mode is reset once the merge is done.
+_bulk_pragmas = ('PRAGMA journal_mode=WAL', 'PRAGMA cache_size=-262144')
+_new_file_pragmas = ('PRAGMA synchronous=OFF',)
+_existing_file_pragmas = ('PRAGMA synchronous=NORMAL',)
+_final_pragmas = ('PRAGMA journal_mode=DELETE',)
+_rows_per_insert = 10000
+_hash_buffer_size = 1024 * 1024
+
+def file_hash(file_name):
+    hasher = hashlib.sha1()
+    with open(file_name, 'rb') as f:
+        for chunk in iter(lambda: f.read(_hash_buffer_size), ''):
+            hasher.update(chunk)
+    return hasher.hexdigest()
+
+def _is_merged(out_conn, file_hash):
+    return out_conn.execute("select 1 from %s where hash=?" % manifest_table, (file_hash,)).fetchone() is not None
+
+# Files are prepared for merging, by checking whether they have been merged and salvaging them,
+# in the merging process or on a pool of workers.  Workers are given the hashes of merged files when they start.
+_merged_hashes = None
+
+def _init_prepare(merged_hashes):
+    global _merged_hashes
+    _merged_hashes = merged_hashes
+
+def _prepare(task):
+    '''Returns the file, whether it can be merged, and the hashes to record it as merged under'''
+    db_file, attempt_salvage, quick_check, decrypt_on_read = task
+    file_hashes = []
+    if _merged_hashes is not None:
+        file_hashes.append(file_hash(db_file))
+        if file_hashes[0] in _merged_hashes:
+            print "Already merged: " + db_file
+            return db_file, False, file_hashes
+    
+    if attempt_salvage and decrypt_on_read and not dbdecrypt.is_funf_database(db_file):
+        # Salvaged as it is decrypted into memory
+        attempt_salvage = False
+    if attempt_salvage:
+        stat = os.stat(db_file)
+        try: 
+            salvage(db_file, quick=quick_check)
+        except (sqlite3.OperationalError,sqlite3.DatabaseError):
+            print "Unable to parse file: " + db_file
+            return db_file, False, file_hashes
+        salvaged_stat = os.stat(db_file)
+        if _merged_hashes is not None and (stat.st_size, stat.st_mtime) != (salvaged_stat.st_size, salvaged_stat.st_mtime):
+            # Also recognize the salvaged file next time
+            file_hashes.append(file_hash(db_file))
+    return db_file, True, file_hashes
+
+def _record_merged(out_conn, db_file, file_hashes, uuid):
+    merged = int(time.time())
+    out_conn.executemany("insert or ignore into %s values (?, ?, ?, ?)" % manifest_table, 
+                         [(file_hash, uuid, os.path.basename(db_file), merged) for file_hash in file_hashes])
+
+def _bulk_insert(out_conn, db_file, insert="insert into data", keys=None):
+    '''Copies the data of a db file into the merged db with one insert ... select over the attached file.
+    Encrypted files are decrypted into memory with the first of keys that matches them.
+
+    Falls back to batches of rows if the data table cannot be read in one statement, keeping the rows read before any error.
+    Returns the uuid of the file, or None if it could not be processed, and whether all of its data was read.'''
+    try:
+        dbdecrypt.attach(out_conn, db_file, 'source', keys)
+    except (sqlite3.OperationalError,sqlite3.DatabaseError):
+        print "Unable to parse file: " + db_file
+        return None, False
+    try:
+        try: 
+            file_info = out_conn.execute("select * from source.%s" % file_info_table).fetchall()
+        except (sqlite3.OperationalError,sqlite3.DatabaseError):
+            print "Unable to parse file: " + db_file
+            return None, False
+        try:
+            id, name, device, uuid, created = file_info[-1]
+        except (IndexError, ValueError):
+            print "No file info exists in: " + db_file
+            return None, False
+        print "Processing %s" % db_file
+        complete = True
+        try:
+            columns = ['"%s"' % row[1] for row in out_conn.execute("PRAGMA source.table_info(%s)" % data_table)]
+            id_column, probe_column, timestamp_column, value_column = columns
+            out_conn.execute("%s select ? || '-' || %s, ?, %s, %s, %s from source.%s" % (insert, id_column, probe_column, timestamp_column, value_column, data_table), 
+                             (uuid, device))
+        except (sqlite3.OperationalError,sqlite3.DatabaseError,ValueError):
+            # Reading a damaged page fails the commit of the transaction the read is in, 
+            # so the rows are read on a connection of their own
+            out_conn.rollback()
+            insert_rows = "%s values (?, ?, ?, ?, ?)" % insert
+            batch = []
+            source_conn = None
+            try:
+                source_conn = dbdecrypt.connect(db_file, keys)
+                for id, probe, timestamp, value in source_conn.execute("select * from %s" % data_table):
+                    batch.append((('%s-%d' % (uuid, id)), device, probe, timestamp, value))
+                    if len(batch) >= _rows_per_insert:
+                        rows, batch = batch, []
+                        out_conn.executemany(insert_rows, rows)
+            except (sqlite3.OperationalError,sqlite3.DatabaseError,IndexError,ValueError):
+                print "Error processing the remainder of the file in: " + db_file
+                complete = False
+            finally:
+                if source_conn is not None:
+                    source_conn.close()
+            # The rows read since the last full batch, including those read before an error
+            out_conn.executemany(insert_rows, batch)
+        return uuid, complete
+    finally:
+        out_conn.commit()
+        out_conn.execute("detach database source")
+
+def _create_schema(out_conn, out_file, indexed, incremental):
+    '''Creates the tables of the merged db, keeping the schema of a file that already has them.
+    Returns whether the schema is indexed, and the statement to insert rows with.'''
+    if out_conn.execute("select 1 from sqlite_master where name=?", (data_table,)).fetchone():
+        # Keep the schema of the file being added to
+        indexed = is_indexed(out_conn)
+    for statement in (_indexed_schema if indexed else _plain_schema):
+        out_conn.execute(statement)
+    insert = "insert into data"
+    if incremental:
+        # Files are skipped if their contents have been merged before, and rows are skipped if their id has.
+        # The manifest is keyed by the uuid and content hash of each file whose data was read completely, and looked up by hash.
+        out_conn.execute('create table if not exists %s (hash text, uuid text, name text, merged long, primary key (uuid, hash))' % manifest_table)
+        out_conn.execute('create index if not exists %s_hash on %s (hash)' % (manifest_table, manifest_table))
+        try:
+            out_conn.execute('create unique index if not exists data_id on %s (id)' % (values_table if indexed else data_table))
+        except sqlite3.IntegrityError:
+            raise Exception("The file '%s' has rows with duplicate ids, so it can not be added to." % out_file)
+        insert = "insert or ignore into data"
+    return indexed, insert
+
+def open_incremental(out_file, indexed=False):
+    '''Opens a merged db file, creating it if needed, to add files to one at a time with add_file.  
+    The file is kept in WAL mode, so it can be read while files are added.'''
+    out_conn = sqlite3.connect(out_file)
+    out_conn.row_factory = sqlite3.Row
+    indexed = _create_schema(out_conn, out_file, indexed, True)[0]
+    if indexed:
+        for statement in _indexed_schema_indexes:
+            out_conn.execute(statement)
+    out_conn.execute('PRAGMA journal_mode=WAL')
+    return out_conn
+
+def add_file(out_conn, db_file, keys=None, content_hash=None):
+    '''Adds a salvaged db file to a merged db opened with open_incremental, unless a file with the same contents was added before.
+    Encrypted files are decrypted into memory with the first of keys that matches them.
+    The file is recorded under content_hash, or the hash of its contents, once all of its data has been read, 
+    so a file that could only be read in part is read again if it is added again.  Returns True if the file was added.'''
+    content_hash = content_hash or file_hash(db_file)
+    if _is_merged(out_conn, content_hash):
+        print "Already merged: " + db_file
+        return False
+    uuid, complete = _bulk_insert(out_conn, db_file, "insert or ignore into data", keys)
+    if uuid is None:
+        return False
+    if complete:
+        _record_merged(out_conn, db_file, [content_hash], uuid)
+        out_conn.commit()
+    return True
+
+def merge(db_files=None, out_file=None, overwrite=False, attempt_salvage=True, bulk=False, incremental=False, jobs=1, quick_check=False, indexed=False, keys=None):
     # Check that db_files are specified and exist
     if not db_files:
         db_files = [file for file in os.listdir(os.curdir) if file.endswith(".db") and not file.startswith("merged")]
@@ -44,55 +278,98 @@ def merge(db_files=None, out_file=None, overwrite=False, attempt_salvage=True):
     
     # Use default filename if it doesn't ixist
     if not out_file:
+        if incremental:
+            raise Exception("Must specify the merged file to add to")
         out_file = 'merged_%d.db' % int(time.time())
     
     if os.path.exists(out_file):
         if overwrite:
             os.remove(out_file)
-        else:
+        elif not incremental:
             raise Exception("The file '%s' already exists." % out_file)
+    new_file = not os.path.exists(out_file)
     
     out_conn = sqlite3.connect(out_file)
     out_conn.row_factory = sqlite3.Row
     out_cursor = out_conn.cursor()
+    indexed, insert = _create_schema(out_conn, out_file, indexed, incremental)
+    if bulk:
+        for pragma in _bulk_pragmas + (_new_file_pragmas if new_file else _existing_file_pragmas):
+            out_conn.execute(pragma)
     
-    out_cursor.execute('create table data (id text, device text, probe text, timestamp long, value text)')
+    merged_hashes = None
+    if incremental:
+        merged_hashes = set([row[0] for row in out_conn.execute("select hash from %s" % manifest_table)])
+    tasks = [(db_file, attempt_salvage, quick_check, bool(keys)) for db_file in db_files]
+    if jobs > 1:
+        pool = Pool(jobs, _init_prepare, (merged_hashes,))
+        prepared_files = pool.imap(_prepare, tasks)
+    else:
+        pool = None
+        _init_prepare(merged_hashes)
+        prepared_files = imap(_prepare, tasks)
     
-    for db_file in db_files:
-        if attempt_salvage:
+    try:
+        for db_file, mergeable, file_hashes in prepared_files:
+            if not mergeable:
+                continue
+            if incremental and _is_merged(out_conn, file_hashes[0]):
+                # Same contents as a file earlier in this merge
+                print "Already merged: " + db_file
+                continue
+            
+            if bulk:
+                uuid, complete = _bulk_insert(out_conn, db_file, insert, keys)
+                if incremental and complete:
+                    _record_merged(out_conn, db_file, file_hashes, uuid)
+                    out_conn.commit()
+                continue
+            
             try: 
-                salvage(db_file)
+                conn = dbdecrypt.connect(db_file, keys)
+                conn.row_factory = sqlite3.Row
+                cursor = conn.cursor()
+                cursor.execute("select * from %s" % file_info_table)
             except (sqlite3.OperationalError,sqlite3.DatabaseError):
                 print "Unable to parse file: " + db_file
                 continue
-        
-        conn = sqlite3.connect(db_file)
-        conn.row_factory = sqlite3.Row
-        cursor = conn.cursor()
-        try: 
-            cursor.execute("select * from %s" % file_info_table)
-        except (sqlite3.OperationalError,sqlite3.DatabaseError):
-            print "Unable to parse file: " + db_file
-            continue
-        else:
-            try:
-                for row in cursor:
-                    id, name, device, uuid, created = row
-            except (sqlite3.OperationalError,sqlite3.DatabaseError,IndexError):
-                print "No file info exists in: " + db_file
-                continue
-            print "Processing %s" % db_file
-            try:
-                cursor.execute("select * from %s" % data_table)
-                for row in cursor:
-                    id, probe, timestamp, value = row
-                    new_row = (('%s-%d' % (uuid, id)), device, probe, timestamp, value)
-                    out_conn.execute("insert into data values (?, ?, ?, ?, ?)", new_row)
-            except (sqlite3.OperationalError,sqlite3.DatabaseError,IndexError):
-                print "Error processing the remainder of the file in: " + db_file
-                continue
-            out_conn.commit()
+            else:
+                try:
+                    for row in cursor:
+                        id, name, device, uuid, created = row
+                except (sqlite3.OperationalError,sqlite3.DatabaseError,IndexError):
+                    print "No file info exists in: " + db_file
+                    continue
+                print "Processing %s" % db_file
+                complete = True
+                try:
+                    cursor.execute("select * from %s" % data_table)
+                    for row in cursor:
+                        id, probe, timestamp, value = row
+                        new_row = (('%s-%d' % (uuid, id)), device, probe, timestamp, value)
+                        out_conn.execute("%s values (?, ?, ?, ?, ?)" % insert, new_row)
+                except (sqlite3.OperationalError,sqlite3.DatabaseError,IndexError):
+                    print "Error processing the remainder of the file in: " + db_file
+                    complete = False
+                if incremental and complete:
+                    # Files that were only read in part are read again next time
+                    _record_merged(out_conn, db_file, file_hashes, uuid)
+                out_conn.commit()
+        if pool is not None:
+            pool.close()
+    finally:
+        if pool is not None:
+            # Stops workers salvaging files in place if the merge fails
+            pool.terminate()
+            pool.join()
+    if indexed:
+        for statement in _indexed_schema_indexes:
+            out_cursor.execute(statement)
+    if bulk:
+        for pragma in _final_pragmas:
+            out_conn.execute(pragma)
     out_cursor.close()
+    out_conn.close()
 
 
 if __name__ == '__main__':
@@ -100,10 +377,31 @@ if __name__ == '__main__':
     description = "Merges many database files into one file."
     parser = OptionParser(usage="%s\n\n%s" % (usage, description))
     parser.add_option("-o", "--output", dest="file", default=None,
-                      help="Filename to merge all files into.  Will not overwrite a file if it already exists.", metavar="FILE")
+                      help="Filename to merge all files into.  Will not overwrite a file if it already exists, unless adding to it with --incremental.", metavar="FILE")
+    parser.add_option("-b", "--bulk", dest="bulk", default=False,
+                      action="store_true",
+                      help="Copy each file with a single insert, with journaling and syncing relaxed until the merge is done.")
+    parser.add_option("-i", "--incremental", dest="incremental", default=False,
+                      action="store_true",
+                      help="Add to an existing merged file, skipping files and rows that have already been merged into it.")
+    parser.add_option("-j", "--jobs", dest="jobs", default=1, type="int",
+                      help="Number of worker processes used to check and salvage files while they are merged.  Defaults to 1.")
+    parser.add_option("-q", "--quick-check", dest="quick_check", default=False,
+                      action="store_true",
+                      help="Use the faster quick_check, which does not verify indexes, to find corrupted files.")
+    parser.add_option("-x", "--indexed", dest="indexed", default=False,
+                      action="store_true",
+                      help="Store device and probe names in lookup tables, and index the data by device, probe and timestamp.  Data is still read from the 'data' view.")
+    parser.add_option("-k", "--key", dest="keys", default=[], action="append",
+                      help="A DES key to read encrypted files with, decrypting them in memory instead of on disk.  Can be given more than once.")
+    parser.add_option("--password", dest="passwords", default=[], action="append",
+                      help="A password to derive a DES key to read encrypted files with from.  Can be given more than once.")
+    parser.add_option("--password-file", dest="password_file", default=None, metavar="FILE",
+                      help="A file of passwords to derive DES keys to read encrypted files with from, one per line.")
     (options, args) = parser.parse_args()
     try:
-        merge(args, options.file)
+        keys = dbdecrypt.load_keys(options.keys, options.passwords, options.password_file)
+        merge(args, options.file, bulk=options.bulk, incremental=options.incremental, jobs=options.jobs, quick_check=options.quick_check, indexed=options.indexed, keys=keys)
     except Exception as e:
         import sys
         sys.exit("ERROR: " + str(e))
\ No newline at end of file
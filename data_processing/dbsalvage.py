@@ -21,12 +21,14 @@
 # License along with Funf. If not, see <http://www.gnu.org/licenses/>.
 # 
 
-'''Attempts to salvage as much data as possible from a corrupted file, by dumping its contents to a new db file.
+'''Attempts to salvage as much data as possible from a corrupted file, by copying the rows that can be read from its pages to a new db file.
 '''
 from optparse import OptionParser
 import sqlite3
 import shutil
+import struct
 import os
+import re
 
 _default_extension = 'corrupted'
 
@@ -36,39 +38,397 @@ def backup_file(file_name, extension=None):
 
 
 
-def salvage(db_file, extension=None):
+# Sqlite file format, see http://www.sqlite.org/fileformat.html
+_header_size = 100
+_interior_table_page = 0x05
+_leaf_table_page = 0x0d
+_salvage_pragmas = ('PRAGMA journal_mode=OFF', 'PRAGMA synchronous=OFF')
+_rows_per_insert = 10000
+
+def _varint(buffer, offset):
+    '''Returns the sqlite varint at the offset, and the offset after it'''
+    byte = ord(buffer[offset])
+    if byte < 0x80:
+        return byte, offset + 1
+    value = 0
+    for i in range(offset, offset + 8):
+        byte = ord(buffer[i])
+        value = (value << 7) | (byte & 0x7f)
+        if byte < 0x80:
+            return value, i + 1
+    return (value << 8) | ord(buffer[offset + 8]), offset + 9
+
+_integer_formats = {1: '>b', 2: '>h', 4: '>i', 8: '>q'}
+
+def _signed(value, bits):
+    return value - (1 << bits) if value >= (1 << (bits - 1)) else value
+
+def _record(payload, text_encoding):
+    '''Decodes the column values of a record'''
+    header_size, offset = _varint(payload, 0)
+    serial_types = []
+    while offset < header_size:
+        serial_type, offset = _varint(payload, offset)
+        serial_types.append(serial_type)
+    values = []
+    offset = header_size
+    for serial_type in serial_types:
+        if serial_type == 0:
+            values.append(None)
+        elif serial_type <= 6:
+            size = (0, 1, 2, 3, 4, 6, 8)[serial_type]
+            data = payload[offset:offset + size]
+            if len(data) < size:
+                raise ValueError("Record is truncated")
+            if size in _integer_formats:
+                values.append(struct.unpack(_integer_formats[size], data)[0])
+            else:
+                values.append(_signed(int(data.encode('hex'), 16), size * 8))
+            offset += size
+        elif serial_type == 7:
+            values.append(struct.unpack('>d', payload[offset:offset + 8])[0])
+            offset += 8
+        elif serial_type in (8, 9):
+            values.append(serial_type - 8)
+        elif serial_type >= 12:
+            size = (serial_type - 12) / 2
+            data = payload[offset:offset + size]
+            if len(data) < size:
+                raise ValueError("Record is truncated")
+            if serial_type % 2 == 0:
+                values.append(buffer(data))
+            elif text_encoding:
+                values.append(data.decode(text_encoding, 'replace'))
+            else:
+                # Utf-8 text is bound as it is
+                values.append(data)
+            offset += size
+        else:
+            raise ValueError("Invalid serial type %d" % serial_type)
+    return values
+
+class PageReader(object):
+    '''Reads the rows of tables by walking their b-tree pages in a sqlite file, or a file object, skipping pages that cannot be read'''
+    
+    def __init__(self, db_file):
+        self.file = open(db_file, 'rb') if isinstance(db_file, basestring) else db_file
+        header = self.file.read(_header_size)
+        if len(header) < _header_size or not header.startswith('SQLite format 3\x00'):
+            self.file.close()
+            raise sqlite3.DatabaseError("file is encrypted or is not a database")
+        self.page_size = struct.unpack('>H', header[16:18])[0]
+        if self.page_size == 1:
+            self.page_size = 65536
+        self.usable_size = self.page_size - ord(header[20])
+        self.text_encoding = {2: 'utf-16-le', 3: 'utf-16-be'}.get(struct.unpack('>I', header[56:60])[0])
+        self.file.seek(0, os.SEEK_END)
+        self.page_count = self.file.tell() / self.page_size
+        self.freelist_trunk, self.freelist_count = struct.unpack('>II', header[32:40])
+        self.unreadable_pages = 0
+        self.visited_pages = set()
+    
+    def close(self):
+        self.file.close()
+    
+    def page(self, page_number):
+        if not 1 <= page_number <= self.page_count:
+            raise ValueError("Page %d is not in the file" % page_number)
+        self.file.seek((page_number - 1) * self.page_size)
+        return self.file.read(self.page_size)
     
+    def payload(self, page, offset, size):
+        '''Returns the payload of a leaf cell, following its overflow pages'''
+        max_local = self.usable_size - 35
+        if size <= max_local:
+            return page[offset:offset + size]
+        min_local = (self.usable_size - 12) * 32 / 255 - 23
+        local = min_local + (size - min_local) % (self.usable_size - 4)
+        if local > max_local:
+            local = min_local
+        parts = [page[offset:offset + local]]
+        remaining = size - local
+        overflow_page, = struct.unpack('>I', page[offset + local:offset + local + 4])
+        visited = set()
+        while remaining > 0:
+            if overflow_page in visited:
+                raise ValueError("Overflow pages loop")
+            visited.add(overflow_page)
+            data = self.page(overflow_page)
+            parts.append(data[4:4 + min(remaining, self.usable_size - 4)])
+            remaining -= self.usable_size - 4
+            overflow_page, = struct.unpack('>I', data[:4])
+        return ''.join(parts)
+    
+    def table_rows(self, root_page):
+        '''Yields the rowid and values of each row that can be read from the table, in rowid order'''
+        visited = set()
+        pages = [root_page]
+        while pages:
+            page_number = pages.pop()
+            if page_number in visited:
+                self.unreadable_pages += 1
+                continue
+            visited.add(page_number)
+            self.visited_pages.add(page_number)
+            try:
+                page = self.page(page_number)
+                offset = _header_size if page_number == 1 else 0
+                page_type = ord(page[offset])
+                cell_count, = struct.unpack('>H', page[offset + 3:offset + 5])
+                if page_type == _interior_table_page:
+                    right_child, = struct.unpack('>I', page[offset + 8:offset + 12])
+                    cell_pointers = struct.unpack('>%dH' % cell_count, page[offset + 12:offset + 12 + 2 * cell_count])
+                    children = [struct.unpack('>I', page[pointer:pointer + 4])[0] for pointer in cell_pointers]
+                    pages.append(right_child)
+                    pages.extend(reversed(children))
+                    continue
+                if page_type != _leaf_table_page:
+                    raise ValueError("Page %d is not a table page" % page_number)
+                cell_pointers = struct.unpack('>%dH' % cell_count, page[offset + 8:offset + 8 + 2 * cell_count])
+            except (ValueError, IndexError, struct.error):
+                self.unreadable_pages += 1
+                continue
+            for row in self.leaf_rows(page, cell_pointers):
+                yield row
+    
+    def leaf_rows(self, page, cell_pointers):
+        '''Yields the rowid and values of each cell of a leaf page that can be read'''
+        for pointer in cell_pointers:
+            try:
+                size, cell_offset = _varint(page, pointer)
+                rowid, cell_offset = _varint(page, cell_offset)
+                values = _record(self.payload(page, cell_offset, size), self.text_encoding)
+            except (ValueError, IndexError, struct.error):
+                continue
+            yield _signed(rowid, 64), values
+    
+    def free_pages(self):
+        '''Returns the pages on the freelist that can be read, which may hold rows that were deleted'''
+        pages = set()
+        trunk_page = self.freelist_trunk
+        while trunk_page and trunk_page not in pages and len(pages) < self.freelist_count:
+            pages.add(trunk_page)
+            try:
+                page = self.page(trunk_page)
+                next_trunk_page, leaf_count = struct.unpack('>II', page[:8])
+                pages.update(struct.unpack('>%dI' % leaf_count, page[8:8 + 4 * leaf_count]))
+            except (ValueError, struct.error):
+                break
+            trunk_page = next_trunk_page
+        return pages
+    
+    def stray_leaf_pages(self):
+        '''Yields the page number and readable rows of each table leaf page that no walk of a table visited, 
+        such as the leaves of a table whose interior pages were lost when the file was truncated'''
+        skipped_pages = self.visited_pages | self.free_pages()
+        for page_number in xrange(2, self.page_count + 1):
+            if page_number in skipped_pages:
+                continue
+            page = self.page(page_number)
+            if ord(page[0]) != _leaf_table_page:
+                continue
+            try:
+                cell_count, = struct.unpack('>H', page[3:5])
+                cell_pointers = struct.unpack('>%dH' % cell_count, page[8:8 + 2 * cell_count])
+            except struct.error:
+                continue
+            rows = list(self.leaf_rows(page, cell_pointers))
+            if rows:
+                yield page_number, rows
+    
+    def tables(self):
+        '''Returns the name, root page and sql of the tables in the schema, the sql of the indexes, 
+        and the sql of the views and triggers, in the order they were created'''
+        tables = []
+        indexes = []
+        views = []
+        for rowid, values in self.table_rows(1):
+            if len(values) < 5 or not values[4]:
+                continue
+            object_type, name, table_name, root_page, sql = values[:5]
+            if object_type == 'table':
+                tables.append((name, root_page, sql))
+            elif object_type == 'index':
+                indexes.append(sql)
+            elif object_type in ('view', 'trigger'):
+                views.append(sql)
+        return tables, indexes, views
+
+def _columns(sql):
+    '''Returns the column definitions of a create table statement'''
+    columns = [column.strip() for column in sql[sql.index('(') + 1:sql.rindex(')')].split(',')]
+    return [column for column in columns if not re.match(r'(constraint|primary|unique|check|foreign)\b', column, re.I)]
+
+def _column_count(sql):
+    '''Returns the number of columns in a create table statement, and the index of the column aliasing the rowid or None'''
+    columns = _columns(sql)
+    rowid_column = None
+    for i, column in enumerate(columns):
+        if re.match(r'\S+\s+integer\s+primary\s+key\b', column, re.I):
+            rowid_column = i
+    return len(columns), rowid_column
+
+def _affinity(column):
+    '''Returns the type affinity of a column definition, see http://www.sqlite.org/datatype3.html'''
+    declared_type = re.match(r'\S+\s*(.*?)\s*(\(|\b(constraint|primary|not|null|unique|check|default|collate|references)\b|$)', column, re.I).group(1).upper()
+    if 'INT' in declared_type:
+        return 'integer'
+    if 'CHAR' in declared_type or 'CLOB' in declared_type or 'TEXT' in declared_type:
+        return 'text'
+    if not declared_type or 'BLOB' in declared_type:
+        return 'blob'
+    if 'REAL' in declared_type or 'FLOA' in declared_type or 'DOUB' in declared_type:
+        return 'real'
+    return 'numeric'
+
+_affinity_types = {
+    'integer': (type(None), int, long, float),
+    'real': (type(None), int, long, float),
+    'numeric': (type(None), int, long, float),
+    'text': (type(None), str, unicode, buffer),
+}
+
+def _record_shape(sql):
+    '''Returns the types of value each column of a create table statement can hold in a record, or None for any type'''
+    column_count, rowid_column = _column_count(sql)
+    shape = [_affinity_types.get(_affinity(column)) for column in _columns(sql)]
+    if rowid_column is not None:
+        # The rowid is stored in place of the column
+        shape[rowid_column] = (type(None),)
+    return shape
+
+def _fits(rows, shape):
+    '''Returns True if the values of every row have the shape of a table's records'''
+    for rowid, values in rows:
+        if len(values) != len(shape):
+            return False
+        for value, types in zip(values, shape):
+            if types is not None and not isinstance(value, types):
+                return False
+    return True
+
+def _in_schema(sql, schema):
+    '''Returns a create table, view or trigger statement that creates it in the attached database schema'''
+    return re.sub(r'(?i)^\s*create\s+(table|view|trigger)\s+(if\s+not\s+exists\s+)?', lambda match: match.group(0) + schema + '.', sql, 1)
+
+def _insert_rows(conn, schema, name, sql, rows, replace=True):
+    '''Inserts rows read from the pages of a table, replacing or ignoring rows with the same rowid.
+    Returns the number of rows inserted and the largest rowid read.'''
+    column_count, rowid_column = _column_count(sql)
+    insert = "insert or %s into %s.\"%s\" values (%s)" % ('replace' if replace else 'ignore', schema, name, ', '.join(['?'] * column_count))
+    changes = conn.total_changes
+    max_rowid = 0
+    batch = []
+    for rowid, values in rows:
+        values = (values + [None] * column_count)[:column_count]
+        if rowid_column is not None:
+            values[rowid_column] = rowid
+        batch.append(values)
+        max_rowid = max(max_rowid, rowid)
+        if len(batch) >= _rows_per_insert:
+            conn.executemany(insert, batch)
+            batch = []
+    conn.executemany(insert, batch)
+    return conn.total_changes - changes, max_rowid
+
+def copy_tables(reader, conn, schema='main'):
+    '''Copies the rows that can be read from the pages of each table to new tables in the schema of the connection, 
+    followed by its views and triggers, and in the main schema its indexes.
+    If any pages could not be read, each table leaf page that no table reached is copied to the first table its rows have the shape of, 
+    trying tables with unreadable pages first, without replacing rows already read.
+    Returns the number of rows recovered and of rowids missing up to the largest rowid used, for each table.'''
+    tables, indexes, views = reader.tables()
+    sequences = {}
+    for name, root_page, sql in tables:
+        if name == 'sqlite_sequence':
+            sequences = dict([tuple(values[:2]) for rowid, values in reader.table_rows(root_page) if len(values) >= 2])
+    tables = [table for table in tables if not table[0].startswith('sqlite_')]
+    recovered = {}
+    max_rowids = {}
+    damaged = set()
+    text_factory = conn.text_factory
+    conn.text_factory = str
+    try:
+        for name, root_page, sql in tables:
+            conn.execute(sql if schema == 'main' else _in_schema(sql, schema))
+            unreadable_pages = reader.unreadable_pages
+            recovered[name], max_rowids[name] = _insert_rows(conn, schema, name, sql, reader.table_rows(root_page))
+            if reader.unreadable_pages > unreadable_pages:
+                damaged.add(name)
+        if reader.unreadable_pages:
+            shapes = sorted([(name not in damaged, name, sql, _record_shape(sql)) for name, root_page, sql in tables], key=lambda shape: shape[0])
+            for page_number, rows in reader.stray_leaf_pages():
+                for undamaged, name, sql, shape in shapes:
+                    if _fits(rows, shape):
+                        count, max_rowid = _insert_rows(conn, schema, name, sql, rows, replace=False)
+                        recovered[name] += count
+                        max_rowids[name] = max(max_rowids[name], max_rowid)
+                        break
+        for sql in views:
+            try:
+                conn.execute(sql if schema == 'main' else _in_schema(sql, schema))
+            except sqlite3.DatabaseError:
+                pass
+        if schema == 'main':
+            for sql in indexes:
+                try:
+                    conn.execute(sql)
+                except sqlite3.DatabaseError:
+                    pass
+        conn.commit()
+    finally:
+        conn.text_factory = text_factory
+    table_counts = {}
+    for name in recovered:
+        max_rowid = max_rowids[name]
+        if isinstance(sequences.get(name), (int, long)):
+            max_rowid = max(max_rowid, sequences[name])
+        table_counts[name] = (recovered[name], max(max_rowid - recovered[name], 0))
+    return table_counts
+
+def salvage_pages(db_file, new_db_file):
+    '''Copies the rows that can be read from the pages of each table in db_file to new_db_file.
+    Returns the number of rows recovered and lost in each table, as copy_tables does, and the number of pages that could not be read.'''
+    reader = PageReader(db_file)
+    try:
+        new_conn = sqlite3.connect(new_db_file)
+        for pragma in _salvage_pragmas:
+            new_conn.execute(pragma)
+        table_counts = copy_tables(reader, new_conn)
+        new_conn.close()
+    finally:
+        reader.close()
+    return table_counts, reader.unreadable_pages
+
+def salvage(db_file, extension=None, quick=False):
+    '''Salvages the file if it fails the integrity check, or the faster quick check which skips verifying indexes.'''
     # Make sure the file exists so we don't create a new file
     with open(db_file, 'rb') as existing_file:
         pass
     
     conn = sqlite3.connect(db_file)
-    cursor = conn.cursor()
-    cursor.execute("PRAGMA integrity_check")
-    if cursor.next()[0] == 'ok':
+    try:
+        corrupted = conn.execute("PRAGMA quick_check" if quick else "PRAGMA integrity_check").fetchone()[0] != 'ok'
+    except sqlite3.DatabaseError:
+        # Too damaged for sqlite to check, the pages may still be readable
+        corrupted = True
+    finally:
         conn.close()
-    else:
+    if corrupted:
         print "%s is corrupted.  Attempting to salvage." % (db_file,)
         new_db_file = db_file + ".new"
-        with sqlite3.connect(new_db_file) as new_conn:
-            new_cursor = new_conn.cursor()
-            try:
-                dumped_file_info_table = False
-                for line in conn.iterdump():
-                    if 'file_info' in line:
-                        dumped_file_info_table = True
-                    new_cursor.execute(line)
-            except sqlite3.DatabaseError as e:
-                # Reached the end of valid data
-                # Ensure that we have the file_info table
-                if not dumped_file_info_table:
-                    file_info_schema = cursor.execute("select sql from sqlite_master where type='table' and name='file_info'").fetchone()[0]
-                    new_cursor.execute(file_info_schema)
-                    file_info_data = cursor.execute("select * from file_info").fetchone()
-                    param_slots = '(' + ', '.join(['?' for item in file_info_data]) + ')'
-                    new_cursor.execute("insert into file_info values %s" % param_slots,  file_info_data )
-            new_conn.commit()
-        conn.close()
+        if os.path.exists(new_db_file):
+            os.remove(new_db_file)
+        try:
+            table_counts, unreadable_pages = salvage_pages(db_file, new_db_file)
+        except:
+            if os.path.exists(new_db_file):
+                os.remove(new_db_file)
+            raise
+        for table, (recovered, missing) in sorted(table_counts.items()):
+            print "%s: recovered %d rows, %d rows lost from %s" % (db_file, recovered, missing, table)
+        if unreadable_pages:
+            print "%s: skipped %d unreadable pages" % (db_file, unreadable_pages)
         
         backup_file_name = backup_file(db_file, extension)
         if not os.path.exists(backup_file_name):
@@ -78,10 +438,13 @@ def salvage(db_file, extension=None):
 
 if __name__ == '__main__':
     usage = "%prog [options] [sqlite_file1.db [sqlite_file2.db...]]"
-    description = "Attempts to salvage as much data as possible from a corrupted file, by starting a new file and dumping in the contents of the corrupted file."
+    description = "Attempts to salvage as much data as possible from a corrupted file, by starting a new file and copying in the rows that can be read from the pages of the corrupted file."
     parser = OptionParser(usage="%s\n\n%s" % (usage, description))
     parser.add_option("-i", "--inplace", dest="extension", default=None,
                       help="The extension to rename the original file to.  Will not overwrite file if it already exists. Defaults to '%s'." % _default_extension,)
+    parser.add_option("-q", "--quick", dest="quick", default=False,
+                      action="store_true",
+                      help="Use the faster quick_check, which does not verify indexes, to find corrupted files.")
     (options, args) = parser.parse_args()
     for file_name in args:
-        salvage(file_name, options.extension)
\ No newline at end of file
+        salvage(file_name, options.extension, options.quick)
\ No newline at end of file
@@ -28,8 +28,10 @@ import shutil
 import os.path
 from Crypto.Cipher import DES
 import struct
+import hashlib
 import string
 import tempfile
+from cStringIO import StringIO
 
 default_password = 'changeme'
 default_extension = "orig"
@@ -38,34 +40,41 @@ _iterations = 135
 _salt = '\xa6\xab\x09\x93\xf4\xcc\xee\x10'
 _key_size = 8
 _block_size = 8
+_buffer_size = 4 * 1024 * 1024 # A multiple of _block_size
+
+sqlite_header = 'SQLite format 3\x00'
+
+def _set_parity(v):
+    '''For DES keys, LSB is odd parity for the key'''
+    return v|0b1 if bin(v >> 1).count('1') % 2 == 0 else v&0b11111110
+
+_parity = ''.join([chr(_set_parity(v)) for v in range(256)])
+
+# Keys derived so far, by password, salt and iterations
+_keys = {}
 
 def key_from_password(password, salt=_salt, iterations=_iterations):
     '''Imitate java's PBEWithMD5AndDES algorithm to produce a DES key'''
-    from Crypto.Hash import MD5
-    hasher = MD5.new()
-    hasher.update(password)
-    hasher.update(salt)
-    result = hasher.digest()
-    for i in range(1, iterations):
-        hasher = MD5.new()
-        hasher.update(result)
-        result = hasher.digest()
-        #test = ' '.join([str( unsigned ) for unsigned in [ord(character) for character in result]])
-        #print test
-
-    key = result[:8]
-    
-
-    # TODO: Not likely, but may need to adjust for twos complement in java
+    cache_key = (password, salt, iterations)
+    if cache_key not in _keys:
+        result = hashlib.md5(password + salt).digest()
+        for i in range(1, iterations):
+            result = hashlib.md5(result).digest()
+        
+        # TODO: Not likely, but may need to adjust for twos complement in java
+        _keys[cache_key] = result[:_key_size].translate(_parity)
+    return _keys[cache_key]
 
-    #For DES keys, LSB is odd parity for the key
-    def set_parity(v):
-        def num1s_notlsb(x):
-            return sum( [x&(1<<i)>0 for i in range(1, 8)] )
-        def even_parity(x):
-            return num1s_notlsb(x)%2 == 0
-        return v|0b1 if even_parity(v) else v&0b11111110
-    return ''.join([chr(set_parity(ord(digit))) for digit in key]) 
+def find_key(file_name, keys):
+    '''Returns the key in keys that decrypts the start of the file to the sqlite header, or None'''
+    with open(file_name, 'rb') as encrypted_file:
+        header = encrypted_file.read(len(sqlite_header))
+    if len(header) < len(sqlite_header):
+        return None
+    for key in keys:
+        if DES.new(key).decrypt(header) == sqlite_header:
+            return key
+    return None
     
 def prompt_for_password():
     from getpass import getpass
@@ -84,27 +93,38 @@ def remove_padding(data):
         return data
     return data[:(data_size - num_padding_bytes)]
 
-def iter_has_next(iterable): 
-    it = iter(iterable) 
-    current = it.next()
-    for i in it: 
-        yield current, True
-        current = i
-    yield current, False
+def decrypt_stream(encrypted_file, output_file, decryptor, buffer_size=_buffer_size):
+    '''Decrypts buffer_size bytes at a time with a single cipher call, and removes the padding from the last buffer'''
+    data = encrypted_file.read(buffer_size)
+    while data:
+        next_data = encrypted_file.read(buffer_size)
+        decrypted = decryptor.decrypt(data)
+        if not next_data:
+            decrypted = remove_padding(decrypted)
+        output_file.write(decrypted)
+        data = next_data
+
+def decrypt_contents(file_name, key):
+    '''Returns the decrypted contents of a file, without writing them to disk.
+    Only the whole blocks of a truncated file are decrypted, and they have no padding to remove.'''
+    output = StringIO()
+    size = os.path.getsize(file_name)
+    with open(file_name, 'rb') as encrypted_file:
+        if size % _block_size:
+            output.write(DES.new(key).decrypt(encrypted_file.read(size - size % _block_size)))
+        else:
+            decrypt_stream(encrypted_file, output, DES.new(key))
+    return output.getvalue()
 
 def decrypt(file_names, key, extension=None):
     assert key != None
     decryptor = DES.new(key)
     for file_name in file_names:
         
-        # Iteratively read 8 byte blocks, decrypt, and write to temp file
+        # Decrypt in large buffers, and write to temp file
         with open(file_name, 'rb') as encrypted_file:
             with tempfile.NamedTemporaryFile(delete=False) as output_file:
-                for chunk, has_next in iter_has_next(iter((lambda:encrypted_file.read(_block_size)),'')):
-                    data = decryptor.decrypt(chunk)
-                    if not has_next:
-                        data = remove_padding(data)
-                    output_file.write(data)
+                decrypt_stream(encrypted_file, output_file, decryptor)
         
         # When successful backup original file, and move temp file to original location
         backup_file_name = backup_file(file_name, extension)
@@ -25,25 +25,37 @@
 '''
 from optparse import OptionParser
 from collections import defaultdict
-import sqlite3
 import json
 from datetime import datetime, timedelta
-from itertools import takewhile, groupby, chain
+from itertools import groupby, chain, imap, islice
+from operator import itemgetter, sub
+from bisect import bisect_left, bisect_right
+from dbmerge import is_indexed, data_filter, parse_time
+import dbdecrypt
 
 _default_package = "edu.mit.media.funf.probe.builtin"
 _default_pipeline = "edu.mit.media.funf.journal.MainPipeline"
 
+# Queries on the tables of an indexed merged file, which can use the (device, probe, timestamp) index
+_indexed_where = "device=(select id from devices where name=?) and probe=(select id from probes where name=?)"
+
 def timestamps(conn, probe, device):
     cursor = conn.cursor()
-    cursor.execute("select timestamp from data where device=? and probe=? order by timestamp asc",  (device, probe))
+    if is_indexed(conn):
+        cursor.execute("select timestamp from data_values where %s order by timestamp asc" % _indexed_where,  (device, probe))
+    else:
+        cursor.execute("select timestamp from data where device=? and probe=? order by timestamp asc",  (device, probe))
     return [x[0] for x in cursor.fetchall()]
 
 def time_gaps(ts):
-    return [cur - prev for prev, cur in zip([ts[0]] + ts[:-1], ts)]
+    return [ts[0] - ts[0]] + list(imap(sub, islice(ts, 1, None), ts))
 
 def devices(conn):
     cursor = conn.cursor()
-    cursor.execute("select distinct(device) from data order by device asc")
+    if is_indexed(conn):
+        cursor.execute("select name from devices order by name asc")
+    else:
+        cursor.execute("select distinct(device) from data order by device asc")
     return [x[0] for x in cursor.fetchall()]
 
 def data_requests(configurations):
@@ -61,7 +73,10 @@ def median(numbers):
 
 def configurations(conn, pipeline, device):
     cursor = conn.cursor()
-    cursor.execute("select timestamp, value from data where probe=? and device=? order by timestamp asc",  (pipeline, device,))
+    if is_indexed(conn):
+        cursor.execute("select timestamp, value from data_values where %s order by timestamp asc" % _indexed_where,  (device, pipeline,))
+    else:
+        cursor.execute("select timestamp, value from data where probe=? and device=? order by timestamp asc",  (pipeline, device,))
     return [(x[0]/1000, json.loads(x[1])) for x in cursor.fetchall()]  # devide by a 100 due to a bug in ConfiguredPipeline
 
 def removed_concecutive_duplicates(L, key=None):
@@ -76,24 +91,44 @@ def probe_period_changes(configurations, probe):
     probe_periods = [(time, get_conf_value(probe_conf, "PERIOD"), get_conf_value(probe_conf, "DURATION"))  for time, probe_conf in probe_confs if probe_conf]
     return removed_concecutive_duplicates(probe_periods, key=lambda x: x[1:])
 
-def probe_period(configurations, probe, time):
-    most_recent = None
-    for conf_time, conf_value in sorted(configurations, key=lambda x: x[0]):
-        if conf_time > time:
-            break
-        most_recent = conf_value
+class PeriodIndex(object):
+    '''Sorted index of the changes to a probe's PERIOD and DURATION, to look up the ones in effect at a time'''
+    
+    no_period_change = (None, None, None)
+    
+    def __init__(self, period_changes):
+        self.period_changes = period_changes
+        self.times = [period_change[0] for period_change in period_changes]
     
-    conf = json.loads(most_recent)
-    probe_conf = conf["dataRequests"].get(probe)
-    return probe_conf[0].get("PERIOD") if len(probe_conf) > 0 else None
+    def period_change(self, time):
+        '''Returns the most recent (time, PERIOD, DURATION) before time'''
+        i = bisect_left(self.times, time)
+        return self.period_changes[i - 1] if i else self.no_period_change
+    
+    def period_at(self, time):
+        '''Returns the most recent (time, PERIOD, DURATION) at or before time'''
+        i = bisect_right(self.times, time)
+        return self.period_changes[i - 1] if i else self.no_period_change
 
-def data_gaps(probe_time_gaps, confs, probe, device):
+def probe_period_indexes(configurations):
+    '''Returns a PeriodIndex for each probe in a device's configurations'''
+    probes = set(chain(*[conf["dataRequests"].keys() for time, conf in configurations]))
+    return dict([(probe, PeriodIndex(probe_period_changes(configurations, probe))) for probe in probes])
 
+def probe_period(configurations, probe, time, period_index=None):
+    '''Returns the PERIOD of the probe in the most recent configuration at time, or None if there is none.  
     
-    
-    period_changes =  probe_period_changes(confs, probe)
+    The configurations must be sorted by time, as returned by configurations().  
+    Pass the probe's PeriodIndex to look up many times without indexing the configurations for each one.'''
+    if period_index is None:
+        configurations = [(conf_time, json.loads(conf) if isinstance(conf, basestring) else conf) for conf_time, conf in configurations]
+        period_index = PeriodIndex(probe_period_changes(configurations, probe))
+    return period_index.period_at(time)[1]
+
+def data_gaps(probe_time_gaps, confs, probe, device, period_index=None):
+    period_index = period_index or PeriodIndex(probe_period_changes(confs, probe))
     def get_period_change(value):
-        return next(takewhile(lambda x: x[0] < value[0], reversed(period_changes)))
+        return period_index.period_change(value[0])
     
     expected_period_to_time_gaps = [(period_change, list(gaps)) 
                                     for period_change, gaps 
@@ -122,30 +157,75 @@ def print_data_gaps(gaps):
         print ("%s (%s - %s)" % (duration, start_time, end_time)).rjust(60)
 
 
-def report(db_file, pipeline=None, probe=None, device=None, all_gaps=False):
-    with sqlite3.connect(db_file) as conn:
+def _plain_device_scans(conn, pipeline, device=None, where='', parameters=()):
+    cursor = conn.cursor()
+    # Configurations are read from the whole history, to know the period at the start of a time window
+    rows_where = "and (probe=? or (%s))" % where if where else ""
+    rows_parameters = [pipeline] + list(parameters) if where else []
+    if device:
+        cursor.execute("select device, probe, timestamp, case when probe=? then value end from data where device=? %s order by probe asc, timestamp asc" % rows_where, 
+                       [pipeline, device] + rows_parameters)
+    else:
+        cursor.execute("select device, probe, timestamp, case when probe=? then value end from data where 1 %s order by device asc, probe asc, timestamp asc" % rows_where, 
+                       [pipeline] + rows_parameters)
+    for device, device_rows in groupby(cursor, itemgetter(0)):
+        confs = []
+        probe_to_timestamps = {}
+        for probe, probe_rows in groupby(device_rows, itemgetter(1)):
+            if probe == pipeline:
+                probe_rows = list(probe_rows)
+                confs = [(timestamp/1000, json.loads(value)) for _, _, timestamp, value in probe_rows]  # devide by a 100 due to a bug in ConfiguredPipeline
+            probe_to_timestamps[probe] = map(itemgetter(2), probe_rows)
+        yield device, confs, probe_to_timestamps
+
+def _indexed_device_scans(conn, pipeline, device=None, where='', parameters=()):
+    probe_names = dict(conn.execute("select id, name from probes"))
+    for device in ([device] if device else devices(conn)):
+        cursor = conn.cursor()
+        cursor.execute("select probe, timestamp from data_values where device=(select id from devices where name=?) %s order by probe asc, timestamp asc" % ("and " + where if where else ""), 
+                       [device] + list(parameters))
+        probe_to_timestamps = dict([(probe_names[probe_id], map(itemgetter(1), probe_rows)) for probe_id, probe_rows in groupby(cursor, itemgetter(0))])
+        yield device, configurations(conn, pipeline, device), probe_to_timestamps
+
+def scan_devices(conn, pipeline, device=None, probe=None, since=None, until=None):
+    '''Yields each device, with its configurations and the sorted timestamps of each of its probes, 
+    or only of the probe, with a timestamp from since until before until.
+
+    Reads a plain merged file with one scan of the data ordered by device, probe and timestamp,
+    and an indexed one with one range scan of the index per device.'''
+    scans = _indexed_device_scans if is_indexed(conn) else _plain_device_scans
+    where, parameters = data_filter(conn, [probe] if probe else (), (), since, until)
+    found = False
+    for device_scan in scans(conn, pipeline, device, where, parameters):
+        found = True
+        yield device_scan
+    if device and not found:
+        yield device, [], {}
+
+def report(db_file, pipeline=None, probe=None, device=None, all_gaps=False, keys=None, since=None, until=None):
+    with dbdecrypt.connect(db_file, keys) as conn:
         pipeline = pipeline or _default_pipeline
-        funf_devices = [device] if device else devices(conn)
-        for device in funf_devices:
+        if probe and "." not in probe:
+            probe = "%s.%s" % (_default_package, probe)
+        for device, confs, probe_to_timestamps in scan_devices(conn, pipeline, device, probe, since, until):
             print
             print "=" * 100
             print "DEVICE: " + device
-            confs = configurations(conn, pipeline, device)
-            if probe and "." not in probe:
-                probe = "%s.%s" % (_default_package, probe)
-            probes = [probe] if probe else sorted(set([probe for probe in chain(*[conf["dataRequests"].keys() for time, conf in confs])]))
+            period_indexes = probe_period_indexes(confs)
+            probes = [probe] if probe else sorted(period_indexes)
             
-            for probe in probes:
+            for device_probe in probes:
                 print
                 print "-" * 100
-                print "PROBE: %s" % probe
+                print "PROBE: %s" % device_probe
                 
-                ts = timestamps(conn, probe, device)
+                ts = probe_to_timestamps.get(device_probe)
                 if not ts:
                     print "No data found!"
                 else:
-                    probe_time_gaps = zip(ts, time_gaps(ts))
-                    time_gap_values = [value for time,value in probe_time_gaps]
+                    time_gap_values = time_gaps(ts)
+                    probe_time_gaps = zip(ts, time_gap_values)
+                    sorted_time_gap_values = sorted(time_gap_values)
                         
                     print 
                     print "%d data entries" % len(ts)
@@ -154,11 +234,11 @@ def report(db_file, pipeline=None, probe=None, device=None, all_gaps=False):
                     print "gathered over %s (%s - %s)" % ((end_datetime - start_datetime), start_datetime, end_datetime)
                     print
                     print "Time between scans"
-                    print "Min: %s" % timedelta(seconds=min(time_gap_values))
-                    print "Median: %s" % timedelta(seconds=median(time_gap_values))
-                    print "Max: %s" % timedelta(seconds=max(time_gap_values))
+                    print "Min: %s" % timedelta(seconds=sorted_time_gap_values[0])
+                    print "Median: %s" % timedelta(seconds=sorted_time_gap_values[len(sorted_time_gap_values)/2])
+                    print "Max: %s" % timedelta(seconds=sorted_time_gap_values[-1])
                     
-                    probe_data_gaps = data_gaps(probe_time_gaps, confs, probe, device)
+                    probe_data_gaps = data_gaps(probe_time_gaps, confs, device_probe, device, period_indexes.get(device_probe))
                     if probe_data_gaps:
                         print 
                         print "Data gaps:"
@@ -169,13 +249,12 @@ def report(db_file, pipeline=None, probe=None, device=None, all_gaps=False):
                       
                     
                     if all_gaps:
-                        counts = histogram(time_gap_values)
                         print
                         print "Time between scans"
                         print "h:mm:ss".rjust(16) + ": <count>"
-                        for value in sorted(counts):
+                        for value, values in groupby(sorted_time_gap_values):
                             gap = timedelta(seconds=value)
-                            print str(gap).rjust(16) + (": %d" % (counts[value],))
+                            print str(gap).rjust(16) + (": %d" % (len(list(values)),))
             
 
 if __name__ == '__main__':
@@ -191,6 +270,16 @@ if __name__ == '__main__':
     parser.add_option("-a", "--all", dest="all", default=False,
                       action="store_true",
                       help="Print out histogram of all data gaps.")
+    parser.add_option("--since", dest="since", default=None,
+                      help="Limit the anaysis to data from this time, in seconds since the epoch or as a local YYYY-MM-DD [HH:MM[:SS]].")
+    parser.add_option("--until", dest="until", default=None,
+                      help="Limit the anaysis to data from before this time, in seconds since the epoch or as a local YYYY-MM-DD [HH:MM[:SS]].")
+    parser.add_option("-k", "--key", dest="keys", default=[], action="append",
+                      help="A DES key to read an encrypted db file with, decrypting it in memory instead of on disk.  Can be given more than once.")
+    parser.add_option("--password", dest="passwords", default=[], action="append",
+                      help="A password to derive a DES key to read an encrypted db file with from.  Can be given more than once.")
+    parser.add_option("--password-file", dest="password_file", default=None, metavar="FILE",
+                      help="A file of passwords to derive DES keys to read an encrypted db file with from, one per line.")
     
     (options, args) = parser.parse_args()
     
@@ -198,5 +287,12 @@ if __name__ == '__main__':
         import sys
         sys.exit("Must specify exactly one db file as an argument.")
 
-    report(args[0], options.pipeline, options.probe, options.device, options.all)
+    try:
+        keys = dbdecrypt.load_keys(options.keys, options.passwords, options.password_file)
+        since = parse_time(options.since) if options.since else None
+        until = parse_time(options.until) if options.until else None
+    except Exception as e:
+        import sys
+        sys.exit("ERROR: " + str(e))
+    report(args[0], options.pipeline, options.probe, options.device, options.all, keys, since, until)
     
\ No newline at end of file
@@ -0,0 +1,90 @@
+#!/usr/bin/env python
+#
+# Funf: Open Sensing Framework
+# Copyright (C) 2010-2011 Nadav Aharony, Wei Pan, Alex Pentland.
+# Acknowledgments: Alan Gardner
+# Contact: nadav@media.mit.edu
+#
+# This file is part of Funf.
+#
+# Funf is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as
+# published by the Free Software Foundation, either version 3 of
+# the License, or (at your option) any later version.
+#
+# Funf is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with Funf. If not, see <http://www.gnu.org/licenses/>.
+#
+
+'''Tests reading encrypted db files in memory
+'''
+import unittest
+import tempfile
+import shutil
+import sqlite3
+import os
+import sys
+from Crypto.Cipher import DES
+from benchmark import make_funf_db, _synthetic_values
+import decrypt
+import dbdecrypt
+import dbmerge
+
+def encrypt_file(file_name, encrypted_file_name, key):
+    '''Encrypts a file the way the Funf app does, with DES and PKCS5 padding'''
+    with open(file_name, 'rb') as plain_file:
+        data = plain_file.read()
+    padding = decrypt._block_size - len(data) % decrypt._block_size
+    with open(encrypted_file_name, 'wb') as encrypted_file:
+        encrypted_file.write(DES.new(key).encrypt(data + chr(padding) * padding))
+
+class EncryptedIndexedFileTest(unittest.TestCase):
+
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp()
+        self.key = decrypt.key_from_password(decrypt.default_password)
+        db_file = os.path.join(self.work_dir, 'funf.db')
+        make_funf_db(db_file, 'uuid-1', 'device-1', _synthetic_values(1000))
+        self.merged_file = os.path.join(self.work_dir, 'merged.db')
+        stdout, sys.stdout = sys.stdout, open(os.devnull, 'w')
+        try:
+            dbmerge.merge([db_file], self.merged_file, indexed=True)
+        finally:
+            sys.stdout.close()
+            sys.stdout = stdout
+        self.encrypted_file = os.path.join(self.work_dir, 'encrypted.db')
+        encrypt_file(self.merged_file, self.encrypted_file, self.key)
+
+    def tearDown(self):
+        shutil.rmtree(self.work_dir)
+
+    def expected_rows(self):
+        conn = sqlite3.connect(self.merged_file)
+        try:
+            return conn.execute("select * from data").fetchall()
+        finally:
+            conn.close()
+
+    def test_connect(self):
+        conn = dbdecrypt.connect(self.encrypted_file, [self.key])
+        try:
+            self.assertTrue(dbmerge.is_indexed(conn))
+            self.assertEqual(conn.execute("select * from data").fetchall(), self.expected_rows())
+        finally:
+            conn.close()
+
+    def test_attach(self):
+        conn = sqlite3.connect(':memory:')
+        try:
+            dbdecrypt.attach(conn, self.encrypted_file, 'source', [self.key])
+            self.assertEqual(conn.execute("select * from source.data").fetchall(), self.expected_rows())
+        finally:
+            conn.close()
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,92 @@
+#!/usr/bin/env python
+#
+# Funf: Open Sensing Framework
+# Copyright (C) 2010-2011 Nadav Aharony, Wei Pan, Alex Pentland.
+# Acknowledgments: Alan Gardner
+# Contact: nadav@media.mit.edu
+#
+# This file is part of Funf.
+#
+# Funf is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as
+# published by the Free Software Foundation, either version 3 of
+# the License, or (at your option) any later version.
+#
+# Funf is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with Funf. If not, see <http://www.gnu.org/licenses/>.
+#
+
+'''Tests salvaging the rows of damaged db files from their pages
+'''
+import unittest
+import tempfile
+import shutil
+import sqlite3
+import os
+import sys
+from benchmark import make_funf_db, _synthetic_values
+import dbsalvage
+import dbmerge
+
+class SalvageTest(unittest.TestCase):
+
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp()
+        self.db_file = os.path.join(self.work_dir, 'funf.db')
+        make_funf_db(self.db_file, 'uuid-1', 'device-1', _synthetic_values(3001))
+
+    def tearDown(self):
+        shutil.rmtree(self.work_dir)
+
+    def salvage_pages(self, db_file):
+        new_db_file = os.path.join(self.work_dir, 'salvaged.db')
+        table_counts, unreadable_pages = dbsalvage.salvage_pages(db_file, new_db_file)
+        return sqlite3.connect(new_db_file), table_counts, unreadable_pages
+
+    def test_truncated_file_keeps_leaves_past_lost_interior_pages(self):
+        with open(self.db_file, 'rb') as db:
+            contents = db.read()
+        truncated_file = os.path.join(self.work_dir, 'truncated.db')
+        with open(truncated_file, 'wb') as truncated:
+            truncated.write(contents[:len(contents) * 6 / 10])
+        # The data table has more than one level of interior pages, the last of them past the end of the truncated file
+        reader = dbsalvage.PageReader(self.db_file)
+        try:
+            root_page = [table[1] for table in reader.tables()[0] if table[0] == 'data'][0]
+            self.assertEqual(ord(reader.page(root_page)[0]), 0x05)
+        finally:
+            reader.close()
+        conn, table_counts, unreadable_pages = self.salvage_pages(truncated_file)
+        self.assertTrue(unreadable_pages > 0)
+        rows = conn.execute("select count(*) from data").fetchone()[0]
+        self.assertTrue(rows > 0)
+        self.assertEqual(table_counts['data'], (rows, 3001 - rows))
+        self.assertEqual(conn.execute("select count(*) from file_info").fetchone()[0], 1)
+        original = sqlite3.connect(self.db_file)
+        self.assertEqual(conn.execute("select * from data order by _id").fetchall(),
+                         original.execute("select * from data where _id in (%s) order by _id" % ','.join([str(row[0]) for row in conn.execute("select _id from data")])).fetchall())
+        original.close()
+        conn.close()
+
+    def test_indexed_merged_file_keeps_view_and_trigger(self):
+        merged_file = os.path.join(self.work_dir, 'merged.db')
+        stdout, sys.stdout = sys.stdout, open(os.devnull, 'w')
+        try:
+            dbmerge.merge([self.db_file], merged_file, indexed=True)
+        finally:
+            sys.stdout.close()
+            sys.stdout = stdout
+        conn, table_counts, unreadable_pages = self.salvage_pages(merged_file)
+        self.assertTrue(dbmerge.is_indexed(conn))
+        self.assertEqual(conn.execute("select count(*) from data").fetchone()[0], 3001)
+        conn.execute("insert into data values ('id', 'device-2', 'probe', 1, 'value')")
+        self.assertEqual(conn.execute("select device from data where id = 'id'").fetchone()[0], 'device-2')
+        conn.close()
+
+if __name__ == '__main__':
+    unittest.main()
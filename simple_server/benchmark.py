@@ -0,0 +1,146 @@
+#!/usr/bin/env python
+#
+# Funf: Open Sensing Framework
+# Copyright (C) 2010-2011 Nadav Aharony, Wei Pan, Alex Pentland.
+# Acknowledgments: Alan Gardner
+# Contact: nadav@media.mit.edu
+# 
+# This file is part of Funf.
+# 
+# Funf is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as
+# published by the Free Software Foundation, either version 3 of
+# the License, or (at your option) any later version.
+# 
+# Funf is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the GNU Lesser General Public License for more details.
+# 
+# You should have received a copy of the GNU Lesser General Public
+# License along with Funf. If not, see <http://www.gnu.org/licenses/>.
+# 
+
+
+'''Load generator for the Funf server.  Uploads files from many concurrent clients and reports uploads per second and latency.
+'''
+from optparse import OptionParser
+import httplib
+import threading
+import subprocess
+import tempfile
+import shutil
+import socket
+import time
+import os
+import sys
+
+server_script = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'funfserver.py')
+
+boundary = 'FunfBenchmarkBoundary'
+
+def multipart_body(filename, data):
+    '''Returns a multipart form body holding data as the uploaded file, as the Funf app sends it'''
+    return ('--%s\r\nContent-Disposition: form-data; name="uploadedfile"; filename="%s"\r\n'
+            'Content-Type: application/octet-stream\r\n\r\n%s\r\n--%s--\r\n') % (boundary, filename, data, boundary)
+
+def client(host, port, uploads, size, keep_alive, latencies, failures):
+    '''Sends uploads one after another, recording the latency of each successful one'''
+    data = os.urandom(size)
+    headers = {'Content-Type': 'multipart/form-data; boundary=%s' % boundary}
+    if not keep_alive:
+        headers['Connection'] = 'close'
+    conn = httplib.HTTPConnection(host, port, timeout=60)
+    for filename in uploads:
+        start = time.time()
+        try:
+            conn.request('POST', '/data', multipart_body(filename, data), headers)
+            response = conn.getresponse()
+            response.read()
+        except (httplib.HTTPException, socket.error) as e:
+            conn.close()
+            failures.append(e.__class__.__name__)
+            continue
+        if response.status == 200:
+            latencies.append(time.time() - start)
+        else:
+            failures.append(response.status)
+        if not keep_alive or response.getheader('Connection', '').lower() == 'close':
+            conn.close()
+    conn.close()
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return float('nan')
+    return sorted_values[min(len(sorted_values) - 1, int(len(sorted_values) * fraction))]
+
+def run_load(host, port, uploads=1000, concurrency=50, size=65536, keep_alive=True):
+    '''Returns uploads per second, the sorted upload latencies, and the failed responses'''
+    latencies, failures = [], []
+    names = ['upload-%d.db' % i for i in xrange(uploads)]
+    threads = [threading.Thread(target=client, args=(host, port, names[i::concurrency], size, keep_alive, latencies, failures))
+               for i in xrange(concurrency)]
+    start = time.time()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.time() - start
+    return len(latencies) / elapsed, sorted(latencies), failures
+
+def free_port():
+    sock = socket.socket()
+    sock.bind(('localhost', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+def start_server(args, upload_dir):
+    '''Starts funfserver.py in a new process, and returns it along with its port once it accepts connections'''
+    port = free_port()
+    devnull = open(os.devnull, 'w')
+    process = subprocess.Popen([sys.executable, server_script, '-u', upload_dir] + args + [str(port)], stdout=devnull, stderr=devnull)
+    for i in xrange(100):
+        try:
+            socket.create_connection(('localhost', port)).close()
+            return process, port
+        except socket.error:
+            time.sleep(0.1)
+    process.kill()
+    raise Exception("Server did not start: %s" % ' '.join(args))
+
+def print_result(name, result):
+    uploads_per_second, latencies, failures = result
+    print "%-30s%15.1f%15.1f%15.1f%15d" % (name, uploads_per_second, 1000 * percentile(latencies, 0.5), 
+                                           1000 * percentile(latencies, 0.99), len(failures))
+
+if __name__ == '__main__':
+    usage = "%prog [options]"
+    description = "Uploads files to the threaded and the async Funf server, or to the server at --address, and reports uploads per second and latency."
+    parser = OptionParser(usage="%s\n\n%s" % (usage, description))
+    parser.add_option("-n", "--uploads", dest="uploads", type="int", default=2000,
+                      help="Number of files to upload.  Defaults to 2000.")
+    parser.add_option("-c", "--concurrency", dest="concurrency", type="int", default=50,
+                      help="Number of clients uploading at the same time.  Defaults to 50.")
+    parser.add_option("-s", "--size", dest="size", type="int", default=65536,
+                      help="Size in bytes of each uploaded file.  Defaults to 65536.")
+    parser.add_option("-k", "--no-keep-alive", dest="keep_alive", action="store_false", default=True,
+                      help="Open a new connection for every upload.")
+    parser.add_option("-a", "--address", dest="address", default=None,
+                      help="host:port of a running server to upload to, instead of starting servers.")
+    (options, args) = parser.parse_args()
+    load = dict(uploads=options.uploads, concurrency=options.concurrency, size=options.size, keep_alive=options.keep_alive)
+    print "%-30s%15s%15s%15s%15s" % ('%d uploads of %d bytes' % (options.uploads, options.size), 'uploads/s', 'p50 ms', 'p99 ms', 'failed')
+    if options.address:
+        host, port = options.address.rsplit(':', 1)
+        print_result(options.address, run_load(host, int(port), **load))
+    else:
+        for name, server_args in [('threaded', []), ('async', ['--async', '--max-connections', str(options.concurrency)])]:
+            upload_dir = tempfile.mkdtemp()
+            process, port = start_server(server_args, upload_dir)
+            try:
+                print_result(name, run_load('localhost', port, **load))
+            finally:
+                process.terminate()
+                process.wait()
+                shutil.rmtree(upload_dir)
@@ -23,108 +23,1497 @@
 
 from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
 from SocketServer import ThreadingMixIn
+from optparse import OptionParser
+from cStringIO import StringIO
+from email.utils import formatdate
+import asyncore
+import asynchat
+import collections
+import gzip
+import hashlib
+import json
+import mimetools
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+import Queue
+import signal
+import re
+import socket
+import sqlite3
+import tempfile
+import threading
 import sys
 import cgi
 import urlparse
 import os.path
 import shutil
 import time
+import uuid
 
 server_dir = os.path.dirname(__file__)
 
 config_path = '/config'
 config_file_path = os.path.join(server_dir, 'config.json')
 
+metrics_path = '/metrics'
+
 upload_path = '/data'
+chunked_upload_path = upload_path + '/uploads'
 upload_dir = os.path.join(server_dir, 'uploads')
+max_upload_size = 100 * 1024 * 1024
+
+# Uploads are written to temporary files, which are only readable by their owner, and are given the mode open() would create them with
+_umask = os.umask(0)
+os.umask(_umask)
+upload_file_mode = 0666 & ~_umask
+
+buffer_size = 65536
+
+retry_after = 30
+
+data_processing_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'data_processing')
+
+class Metrics(object):
+    '''Counters, gauges and histograms of the server, rendered in the Prometheus text format.  
+    Each value is kept by metric name and a tuple of (label, value) pairs.'''
+    
+    buckets = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+    
+    descriptions = (
+        ('funf_requests_total', 'counter', 'Requests by path and response status.'),
+        ('funf_upload_bytes_total', 'counter', 'Bytes of upload request bodies received.'),
+        ('funf_connections_in_flight', 'gauge', 'Open client connections.'),
+        ('funf_request_seconds', 'histogram', 'Time from reading the request headers to sending the response, by path.'),
+        ('funf_multipart_parse_seconds', 'histogram', 'Time spent parsing each multipart upload, not counting writing the file.'),
+        ('funf_upload_write_seconds', 'histogram', 'Time spent writing the file of each upload or chunk to disk.'),
+        ('funf_ingest_queue_depth', 'gauge', 'Uploads waiting to be ingested.'),
+        ('funf_ingest_in_progress', 'gauge', 'Uploads being decrypted, salvaged or merged.'),
+        ('funf_ingest_files_total', 'counter', 'Uploads ingested, by result.'),
+        ('funf_ingest_lag_seconds', 'gauge', 'Time from upload to merge of the last ingested file.'),
+        ('funf_ingest_lag_seconds_total', 'counter', 'Time from upload to merge of all ingested files.'),
+    )
+    
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.values = {}
+        self.histograms = {}
+    
+    def inc(self, name, value=1, labels=()):
+        with self.lock:
+            key = (name, labels)
+            self.values[key] = self.values.get(key, 0) + value
+    
+    def observe(self, name, value, labels=()):
+        with self.lock:
+            key = (name, labels)
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = [[0] * len(self.buckets), 0, 0]
+            counts = histogram[0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+            histogram[1] += value
+            histogram[2] += 1
+    
+    def render(self, gauges=()):
+        '''Returns the metrics in the Prometheus text format, along with extra (name, labels, value) gauges'''
+        with self.lock:
+            values = sorted([(name, labels, value) for (name, labels), value in self.values.items()] + list(gauges))
+            histograms = sorted((key, (list(counts), total, count)) for key, (counts, total, count) in self.histograms.items())
+        lines = []
+        for name, metric_type, help in self.descriptions:
+            samples = [(name, labels, value) for sample_name, labels, value in values if sample_name == name]
+            for (sample_name, labels), (counts, total, count) in histograms:
+                if sample_name == name:
+                    samples.extend((name + '_bucket', labels + (('le', str(bound)),), bucket_count) 
+                                   for bound, bucket_count in zip(self.buckets, counts) + [('+Inf', count)])
+                    samples.extend([(name + '_sum', labels, total), (name + '_count', labels, count)])
+            if not samples:
+                continue
+            lines.append('# HELP %s %s' % (name, help))
+            lines.append('# TYPE %s %s' % (name, metric_type))
+            for sample_name, labels, value in samples:
+                label_text = ','.join('%s="%s"' % (label, str(label_value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')) 
+                                      for label, label_value in labels)
+                lines.append('%s%s %s' % (sample_name, '{%s}' % label_text if label_text else '', repr(float(value))))
+        return '\n'.join(lines) + '\n'
+
+metrics = Metrics()
+
+def metric_path(path):
+    '''Returns the path requests are counted under, leaving out upload ids so the number of paths stays small'''
+    if path in (config_path, upload_path, chunked_upload_path, metrics_path):
+        return path
+    if path and path.startswith(chunked_upload_path + '/'):
+        return chunked_upload_path + '/<id>'
+    return 'other'
+
+class AccessLog(object):
+    '''Writes a json line for each request to a file, buffering the lines and writing them at most once every flush_interval seconds'''
+    
+    flush_interval = 1
+    max_lines = 10000
+    
+    def __init__(self, path):
+        self.file = open(path, 'a')
+        self.lock = threading.Lock()
+        self.lines = []
+        self.flushed = time.time()
+    
+    def log(self, **fields):
+        line = json.dumps(fields)
+        with self.lock:
+            self.lines.append(line)
+            if len(self.lines) >= self.max_lines or time.time() - self.flushed >= self.flush_interval:
+                self.write()
+    
+    def write(self):
+        if self.lines:
+            self.file.write('\n'.join(self.lines) + '\n')
+            self.file.flush()
+            self.lines = []
+        self.flushed = time.time()
+    
+    def flush(self, force=True):
+        '''Writes the buffered lines, or only if they are due when force is False'''
+        with self.lock:
+            if force or time.time() - self.flushed >= self.flush_interval:
+                self.write()
+    
+    def start(self):
+        '''Starts writing buffered lines when they are due, for servers without an event loop to do it'''
+        thread = threading.Thread(target=self.run)
+        thread.daemon = True
+        thread.start()
+    
+    def run(self):
+        while True:
+            time.sleep(self.flush_interval)
+            try:
+                self.flush(force=False)
+            except Exception as e:
+                print "Unable to write access log: %s" % e
+
+access_log = None
 
-def read_config():
+def record_request(client_address, command, path, code, size, started):
+    '''Counts and times a request, and logs it if there is an access log'''
+    now = time.time()
+    path = metric_path(path)
+    metrics.inc('funf_requests_total', labels=(('path', path), ('status', str(code))))
+    if started is not None:
+        metrics.observe('funf_request_seconds', now - started, labels=(('path', path),))
+    if access_log is not None:
+        access_log.log(time=now, client=client_address[0], method=command, path=path, status=code, bytes=size, 
+                       seconds=round(now - started, 6) if started is not None else None)
+
+def ingest_gauges():
+    '''Returns the ingest metrics as (name, labels, value) gauges'''
+    if ingester is None:
+        return []
+    ingest = ingester.metrics()
+    return [('funf_ingest_queue_depth', (), ingest['queue_depth']), ('funf_ingest_in_progress', (), ingest['in_progress']), 
+            ('funf_ingest_files_total', (('result', 'ingested'),), ingest['ingested']), 
+            ('funf_ingest_files_total', (('result', 'failed'),), ingest['failed']), 
+            ('funf_ingest_files_total', (('result', 'dropped'),), ingest['dropped']), 
+            ('funf_ingest_lag_seconds', (), ingest['last_lag']), ('funf_ingest_lag_seconds_total', (), ingest['total_lag'])]
+
+def read_config(path):
     config = None
     try:
-        with open(config_file_path) as config_file:
+        with open(path) as config_file:
             config = config_file.read()
     except IOError:
         pass
     return config
 
+def gzip_bytes(data):
+    output = StringIO()
+    with gzip.GzipFile(fileobj=output, mode='wb', mtime=0) as gzip_file:
+        gzip_file.write(data)
+    return output.getvalue()
+
+def load_config(path):
+    '''Returns the config in a file, its gzipped form and its ETag, or None if the file cannot be read'''
+    config = read_config(path)
+    if config:
+        return config, gzip_bytes(config), '"%s"' % hashlib.sha1(config).hexdigest()
+    return None
+
+def load_devices(path):
+    '''Returns the study name of each device id in a devices file, or None if the file cannot be read'''
+    try:
+        with open(path) as devices_file:
+            return dict(json.load(devices_file))
+    except (IOError, ValueError, TypeError) as e:
+        print "Unable to read devices file %s: %s" % (path, e)
+        return None
+
+class ConfigIndex(object):
+    '''Holds the default config file, and the study configs in config_dir, in memory, along with their ETags and gzipped forms.  
+    A study's config is the file <study>.json in config_dir, and devices.json in config_dir maps device ids to study names.
+    Once started, files are checked every check_interval seconds, or after reload() is called, on a background thread, 
+    and only changed files are read again, so requests only look up the configs.'''
+    
+    check_interval = 1
+    devices_file_name = 'devices.json'
+    
+    def __init__(self, config_dir=None):
+        self.config_dir = config_dir
+        self.reload_requested = False
+        self.reload_event = threading.Event()
+        self.files = {}
+        self.default = None
+        self.studies = {}
+        self.devices = {}
+    
+    def reload(self):
+        self.reload_requested = True
+        self.reload_event.set()
+    
+    def start(self):
+        '''Reads the config files, and starts checking them for changes'''
+        self.refresh()
+        thread = threading.Thread(target=self.run)
+        thread.daemon = True
+        thread.start()
+    
+    def run(self):
+        while True:
+            self.reload_event.wait(self.check_interval)
+            self.reload_event.clear()
+            try:
+                self.refresh()
+            except Exception as e:
+                print "Unable to check config files: %s" % e
+    
+    def config_files(self):
+        '''Returns the path of each config file, by study name, with None for the default config file'''
+        paths = {None: config_file_path}
+        if self.config_dir:
+            try:
+                file_names = os.listdir(self.config_dir)
+            except OSError:
+                file_names = []
+            for file_name in file_names:
+                study, extension = os.path.splitext(file_name)
+                if extension == '.json' and file_name != self.devices_file_name:
+                    paths[study] = os.path.join(self.config_dir, file_name)
+        return paths
+    
+    def refresh(self):
+        '''Reads the config files that changed since the last refresh, and rebuilds the index if any did'''
+        reload_requested, self.reload_requested = self.reload_requested, False
+        paths = self.config_files()
+        devices_path = os.path.join(self.config_dir, self.devices_file_name) if self.config_dir else None
+        changed = False
+        files = {}
+        for path in paths.values() + [devices_path]:
+            try:
+                stat = os.stat(path)
+            except (OSError, TypeError):
+                continue
+            signature = [stat.st_size, stat.st_mtime]
+            if not reload_requested and path in self.files and self.files[path][0] == signature:
+                files[path] = self.files[path]
+                continue
+            if path == devices_path:
+                value = load_devices(path)
+            else:
+                value = load_config(path)
+                if value is None:
+                    print "Unable to read config file %s" % path
+            files[path] = signature, value
+            changed = True
+        if not changed and len(files) == len(self.files):
+            return
+        self.files = files
+        studies = dict((study, files[path][1]) for study, path in paths.items() if path in files and files[path][1] is not None)
+        devices = {}
+        if devices_path in files:
+            for device, study in (files[devices_path][1] or {}).items():
+                if isinstance(study, basestring) and study in studies:
+                    devices[device] = studies[study]
+                else:
+                    print "Device %s is assigned to unknown study %s" % (device, study)
+        self.default = studies.pop(None, None)
+        self.studies = studies
+        self.devices = devices
+    
+    def get(self, study=None, device=None):
+        '''Returns the config for a study, or for the study a device is in, and otherwise the default config.  
+        Each config is a tuple of the config, its gzipped form and its ETag.  Returns None if there is no such study or config file.'''
+        if study is not None:
+            return self.studies.get(study)
+        return self.devices.get(device, self.default)
+
+config_index = ConfigIndex()
+
+def accepts_gzip(headers):
+    for coding in headers.get('Accept-Encoding', '').split(','):
+        coding, params = cgi.parse_header(coding)
+        if coding.lower() in ('gzip', 'x-gzip', '*'):
+            try:
+                return float(params.get('q', 1)) > 0
+            except ValueError:
+                return False
+    return False
+
 def backup_file(filepath):
     shutil.move(filepath, filepath + '.' + str(int(time.time()*1000)) + '.bak')
 
-def write_file(filename, file):
-    if not os.path.exists(upload_dir):
-        os.mkdir(upload_dir)
+class ContentStore(object):
+    '''Stores uploads under the sha1 of their contents, in subdirectories named by the first two hex digits of the hash, 
+    so files with the same contents are only stored once.  An index db records the hashes each file name was uploaded with.'''
+    
+    index_file_name = 'index.db'
+    
+    def __init__(self, directory):
+        self.directory = directory
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(os.path.join(directory, self.index_file_name), check_same_thread=False)
+        self.conn.execute('create table if not exists uploads (name text, hash text, size long, uploaded long, primary key (name, hash))')
+        self.conn.commit()
+    
+    def path(self, content_hash):
+        return os.path.join(self.directory, content_hash[:2], content_hash + '.db')
+    
+    def store(self, filename, upload):
+        '''Stores a complete upload unless its contents are already stored, returning its path and whether it was new'''
+        content_hash = upload.hexdigest()
+        path = self.path(content_hash)
+        new = not os.path.exists(path)
+        if new:
+            if not os.path.exists(os.path.dirname(path)):
+                try:
+                    os.mkdir(os.path.dirname(path))
+                except OSError:
+                    # Created by another upload
+                    pass
+            upload.save(path)
+        else:
+            upload.abort()
+        with self.lock:
+            self.conn.execute('insert or ignore into uploads values (?, ?, ?, ?)', (filename, content_hash, upload.size, int(time.time())))
+            self.conn.commit()
+        return path, new
+    
+    def versions(self, filename):
+        '''Returns the paths of the files uploaded with a name, oldest first'''
+        with self.lock:
+            rows = self.conn.execute('select hash from uploads where name=? order by uploaded, rowid', (filename,)).fetchall()
+        return [self.path(content_hash) for content_hash, in rows]
+
+content_store = None
+
+def safe_filename(filename):
+    '''Returns the last component of an uploaded file name, so files stay in the upload directory, or None if there is none'''
+    filename = os.path.basename(filename.replace('\\', '/'))
+    if filename in ('', '.', '..'):
+        return None
+    return filename
+
+def store_upload(filename, upload):
+    '''Stores a complete upload, returning its path and whether its contents are new'''
+    if content_store is not None:
+        return content_store.store(filename, upload)
     filepath = os.path.join(upload_dir, filename)
     if os.path.exists(filepath):
         backup_file(filepath)
-    with open(filepath, 'wb') as output_file:
-        while True:
-            chunk = file.read(1024)
+    upload.save(filepath)
+    return filepath, True
+
+class UploadParser(object):
+    '''Parses a multipart/form-data body as it arrives, hashing the uploaded file part and keeping it in memory, 
+    or once it is larger than memory_size, in a temporary file in the upload directory.  
+    The file is stored once the body is complete.  Raises ValueError for a malformed body.'''
+    
+    max_part_header_size = 65536
+    memory_size = 256 * 1024
+    
+    def __init__(self, boundary, field='uploadedfile'):
+        self.delimiter = '\r\n--' + boundary
+        self.field = field
+        # The first boundary need not follow a line break
+        self.buffer = '\r\n'
+        self.state = 'preamble'
+        self.filename = None
+        self.writing = False
+        self.hasher = hashlib.sha1()
+        self.size = 0
+        self.chunks = []
+        self.temp_path = None
+        self.output = None
+        self.parse_seconds = 0
+        self.write_seconds = 0
+    
+    def feed(self, data):
+        started = time.time()
+        write_seconds = self.write_seconds
+        try:
+            self.parse(data)
+        finally:
+            self.parse_seconds += time.time() - started - (self.write_seconds - write_seconds)
+    
+    def parse(self, data):
+        buffer = self.buffer + data if self.buffer else data
+        position = 0
+        while position < len(buffer):
+            if self.state == 'preamble' or self.state == 'part':
+                index = buffer.find(self.delimiter, position)
+                if index < 0:
+                    # Keep what could be the start of a delimiter
+                    end = max(position, len(buffer) - len(self.delimiter) + 1)
+                    if self.writing:
+                        self.write(buffer[position:end])
+                    position = end
+                    break
+                if self.writing:
+                    self.write(buffer[position:index])
+                    self.writing = False
+                position = index + len(self.delimiter)
+                self.state = 'delimiter'
+            elif self.state == 'delimiter':
+                if buffer.startswith('--', position):
+                    self.state = 'end'
+                    continue
+                end = buffer.find('\r\n', position)
+                if end < 0:
+                    if len(buffer) - position > 1024:
+                        raise ValueError("Invalid multipart boundary line")
+                    break
+                if buffer[position:end].strip(' \t'):
+                    raise ValueError("Invalid multipart boundary line")
+                position = end + 2
+                self.state = 'headers'
+            elif self.state == 'headers':
+                if buffer.startswith('\r\n', position):
+                    end = position
+                else:
+                    end = buffer.find('\r\n\r\n', position)
+                    if end < 0:
+                        if len(buffer) - position > self.max_part_header_size:
+                            raise ValueError("Multipart headers too long")
+                        break
+                self.start_part(buffer[position:end])
+                position = end + (2 if end == position else 4)
+                self.state = 'part'
+            else:
+                position = len(buffer)
+        self.buffer = buffer[position:]
+    
+    def start_part(self, header_text):
+        for line in header_text.split('\r\n'):
+            name, _, value = line.partition(':')
+            if name.strip().lower() == 'content-disposition':
+                disposition, params = cgi.parse_header(value)
+                if params.get('name') == self.field and self.filename is None:
+                    filename = safe_filename(params.get('filename', ''))
+                    if not filename:
+                        raise ValueError("Uploaded file has no name")
+                    self.filename = filename
+                    self.writing = True
+    
+    def write(self, data):
+        self.hasher.update(data)
+        self.size += len(data)
+        if self.output:
+            started = time.time()
+            self.output.write(data)
+            self.write_seconds += time.time() - started
+        else:
+            self.chunks.append(data)
+            if self.size > self.memory_size:
+                self.spill()
+    
+    def spill(self):
+        '''Moves the part of the file read so far from memory to a temporary file'''
+        started = time.time()
+        if not os.path.exists(upload_dir):
+            os.mkdir(upload_dir)
+        fd, self.temp_path = tempfile.mkstemp(suffix='.part', prefix='.', dir=upload_dir)
+        self.output = os.fdopen(fd, 'wb')
+        self.output.writelines(self.chunks)
+        self.chunks = []
+        self.write_seconds += time.time() - started
+    
+    def hexdigest(self):
+        return self.hasher.hexdigest()
+    
+    def save(self, path):
+        '''Writes the complete file to path, replacing it in one rename'''
+        if not self.output:
+            self.spill()
+        started = time.time()
+        self.output.close()
+        self.output = None
+        os.chmod(self.temp_path, upload_file_mode)
+        os.rename(self.temp_path, path)
+        self.temp_path = None
+        self.write_seconds += time.time() - started
+    
+    def close(self):
+        '''Stores the uploaded file, returning its path and whether its contents are new, or None if the body had no uploaded file'''
+        if self.state != 'end':
+            self.abort()
+            raise ValueError("Multipart body ended before its closing boundary")
+        if self.filename is not None:
+            return store_upload(self.filename, self)
+    
+    def finish(self):
+        return finish_upload(self)
+    
+    def abort(self):
+        '''Discards the file'''
+        self.chunks = []
+        if self.output:
+            self.output.close()
+            self.output = None
+        if self.temp_path and os.path.exists(self.temp_path):
+            os.remove(self.temp_path)
+        self.temp_path = None
+
+def add_range(ranges, start, end):
+    '''Adds the byte range [start, end) to a sorted list of disjoint ranges, merging the ranges it overlaps or touches'''
+    merged = []
+    for range_start, range_end in ranges:
+        if range_end < start or range_start > end:
+            merged.append([range_start, range_end])
+        else:
+            start, end = min(start, range_start), max(end, range_end)
+    merged.append([start, end])
+    return sorted(merged)
+
+class ChunkedUpload(object):
+    '''An upload sent as byte ranges, which are written in place to a file preallocated to the full size of the upload.  
+    The name, size and received ranges are kept in a json file next to it, so the upload can be resumed after a restart.  
+    Ranges can only be written until the upload is finished, and it can only be finished while no range is being written.'''
+    
+    def __init__(self, upload_id, path, name=None, size=None):
+        self.id = upload_id
+        self.path = path
+        self.state_path = path + '.json'
+        self.lock = threading.RLock()
+        self.finished = False
+        self.writers = 0
+        if name is None:
+            with open(self.state_path) as state_file:
+                state = json.load(state_file)
+            self.name, self.size, self.received = state['name'], state['size'], state['received']
+        else:
+            self.name, self.size, self.received = name, size, []
+    
+    def save_state(self):
+        temp_path = self.state_path + '.tmp'
+        with open(temp_path, 'w') as state_file:
+            json.dump(dict(name=self.name, size=self.size, received=self.received), state_file)
+        os.rename(temp_path, self.state_path)
+    
+    def start_write(self):
+        '''Counts a writer of a range, returning False if the upload is finished'''
+        with self.lock:
+            if self.finished:
+                return False
+            self.writers += 1
+            return True
+    
+    def end_write(self, start, end):
+        '''Records the range a writer wrote, unless the upload was finished while it was writing'''
+        with self.lock:
+            self.writers -= 1
+            if end > start and not self.finished:
+                self.received = add_range(self.received, start, end)
+                self.save_state()
+    
+    def status(self):
+        '''Returns the name and size of the upload, and the byte ranges received, as json'''
+        with self.lock:
+            return json.dumps(dict(name=self.name, size=self.size, received=self.received))
+    
+    def complete(self):
+        return self.size == 0 or self.received == [[0, self.size]]
+    
+    def hexdigest(self):
+        hasher = hashlib.sha1()
+        with open(self.path, 'rb') as upload_file:
+            for chunk in iter(lambda: upload_file.read(buffer_size), ''):
+                hasher.update(chunk)
+        return hasher.hexdigest()
+    
+    def save(self, path):
+        os.rename(self.path, path)
+        os.remove(self.state_path)
+    
+    def abort(self):
+        for path in (self.path, self.state_path):
+            if os.path.exists(path):
+                os.remove(path)
+    
+    def expire(self, idle_timeout):
+        '''Removes the upload if no range has been received for idle_timeout seconds and none is being written, returning whether it was removed'''
+        with self.lock:
+            if self.finished or self.writers:
+                return False
+            try:
+                if time.time() - os.path.getmtime(self.state_path) < idle_timeout:
+                    return False
+            except OSError:
+                pass
+            self.finished = True
+            self.abort()
+            return True
+
+class ChunkReceiver(object):
+    '''Writes the body of a PUT request to a chunked upload, at the offset of its range'''
+    
+    def __init__(self, upload, start):
+        self.upload = upload
+        self.start = start
+        self.written = 0
+        self.write_seconds = 0
+        try:
+            self.output = open(upload.path, 'r+b')
+        except:
+            upload.end_write(start, start)
+            raise
+        self.output.seek(start)
+    
+    def feed(self, data):
+        started = time.time()
+        self.output.write(data)
+        self.written += len(data)
+        self.write_seconds += time.time() - started
+    
+    def abort(self):
+        '''Keeps the part of the range that was received, so the client only sends the rest again'''
+        if self.output:
+            started = time.time()
+            self.output.close()
+            self.output = None
+            metrics.observe('funf_upload_write_seconds', self.write_seconds + time.time() - started)
+            self.upload.end_write(self.start, self.start + self.written)
+    
+    def finish(self):
+        self.abort()
+        return 200, self.upload.status(), [('Content-Type', 'application/json')]
+
+class ChunkedUploads(object):
+    '''The chunked uploads in progress, kept in a hidden directory of the upload directory.  
+    At most max_uploads can be open at once, and uploads that receive nothing for idle_timeout seconds are removed, 
+    checking at most once every sweep_interval seconds when an upload is created.'''
+    
+    directory_name = '.partial'
+    max_uploads = 1000
+    idle_timeout = 24 * 60 * 60
+    sweep_interval = 60
+    
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.uploads = {}
+        self.swept = 0
+    
+    def directory(self):
+        return os.path.join(upload_dir, self.directory_name)
+    
+    def upload_ids(self):
+        '''Returns the ids of the uploads with a state file'''
+        return [file_name[:-len('.json')] for file_name in os.listdir(self.directory()) if file_name.endswith('.json')]
+    
+    def sweep(self):
+        '''Removes the uploads that have been idle for idle_timeout seconds'''
+        now = time.time()
+        for upload_id in self.upload_ids():
+            try:
+                idle = now - os.path.getmtime(os.path.join(self.directory(), upload_id + '.json')) >= self.idle_timeout
+            except OSError:
+                continue
+            try:
+                upload = self.get(upload_id) if idle else None
+            except (IOError, ValueError, KeyError) as e:
+                print "Unable to read chunked upload %s: %s" % (upload_id, e)
+                continue
+            if upload is not None and upload.expire(self.idle_timeout):
+                print "Removed idle chunked upload %s of %s" % (upload_id, upload.name)
+                self.remove(upload)
+    
+    def create(self, name, size):
+        '''Starts an upload, returning None if max_uploads are already open'''
+        if not os.path.exists(self.directory()):
+            os.makedirs(self.directory())
+        if time.time() - self.swept >= self.sweep_interval:
+            self.swept = time.time()
+            self.sweep()
+        upload_id = uuid.uuid4().hex
+        path = os.path.join(self.directory(), upload_id)
+        with self.lock:
+            if len(self.upload_ids()) >= self.max_uploads:
+                return None
+            with open(path, 'wb') as upload_file:
+                upload_file.truncate(size)
+            upload = ChunkedUpload(upload_id, path, name, size)
+            upload.save_state()
+            self.uploads[upload_id] = upload
+        return upload
+    
+    def get(self, upload_id):
+        '''Returns the upload with an id, or None if there is none'''
+        if not re.match('^[0-9a-f]{32}$', upload_id):
+            return None
+        with self.lock:
+            upload = self.uploads.get(upload_id)
+            if upload is None:
+                path = os.path.join(self.directory(), upload_id)
+                if os.path.exists(path + '.json'):
+                    upload = self.uploads[upload_id] = ChunkedUpload(upload_id, path)
+            return upload
+    
+    def remove(self, upload):
+        with self.lock:
+            self.uploads.pop(upload.id, None)
+
+chunked_uploads = ChunkedUploads()
+
+def prepare_upload(file_name, key, copy=False):
+    '''Decrypts and salvages an uploaded file, or a copy of it, returning the file to merge and the hash to record it under,
+    or None if it can not be merged.  Copies are made in a temporary directory in the upload directory, which the caller removes.
+    The hash is the hash of the uploaded file for a copy, and None otherwise.'''
+    import dbdecrypt
+    import dbmerge
+    import dbsalvage
+    content_hash = None
+    if copy:
+        # Stored files must keep the contents they are named after
+        content_hash = dbmerge.file_hash(file_name)
+        work_dir = tempfile.mkdtemp(prefix='.ingest-', dir=upload_dir)
+        copy_name = os.path.join(work_dir, os.path.basename(file_name))
+        shutil.copyfile(file_name, copy_name)
+        file_name = copy_name
+    prepared = None
+    try:
+        if dbdecrypt.decrypt_if_not_db_file(file_name, key):
+            dbsalvage.salvage(file_name)
+            prepared = file_name, content_hash
+    except (sqlite3.OperationalError, sqlite3.DatabaseError):
+        print "Unable to parse file: " + file_name
+    finally:
+        if copy and prepared is None:
+            shutil.rmtree(work_dir, ignore_errors=True)
+    return prepared
+
+class Ingester(object):
+    '''Merges uploads into a merged db as they arrive.  
+    Finished uploads wait in a queue of at most queue_size files, are decrypted and salvaged on a pool of jobs worker processes, 
+    and are added to the merged db in upload order by a single writer thread.  
+    With copy_uploads, uploads are left as they are stored, and copies of them are decrypted and salvaged instead.'''
+    
+    def __init__(self, merged_file, key, jobs=1, queue_size=1000, indexed=False, copy_uploads=False):
+        if data_processing_dir not in sys.path:
+            sys.path.append(data_processing_dir)
+        import dbmerge
+        self.dbmerge = dbmerge
+        self.merged_file = merged_file
+        self.key = key
+        self.jobs = jobs
+        self.copy_uploads = copy_uploads
+        self.queue = Queue.Queue(queue_size)
+        self.lock = threading.Lock()
+        self.in_progress = 0
+        self.ingested = 0
+        self.failed = 0
+        self.dropped = 0
+        self.last_lag = 0
+        self.total_lag = 0
+        # Fails early if the merged file can not be used
+        self.dbmerge.open_incremental(merged_file, indexed).close()
+        # Workers leave interrupts to the server
+        self.pool = multiprocessing.Pool(jobs, signal.signal, (signal.SIGINT, signal.SIG_IGN))
+        self.writer = threading.Thread(target=self.run)
+        self.writer.daemon = True
+        self.writer.start()
+    
+    def full(self):
+        return self.queue.full()
+    
+    def put(self, file_name):
+        '''Queues a finished upload, returning False if the queue is full.  Files that are not queued stay in the upload directory.'''
+        try:
+            self.queue.put_nowait((file_name, time.time()))
+            return True
+        except Queue.Full:
+            print "Ingest queue full, not ingesting: " + file_name
+            with self.lock:
+                self.dropped += 1
+            return False
+    
+    def run(self):
+        out_conn = self.dbmerge.open_incremental(self.merged_file)
+        pending = collections.deque()
+        stopping = False
+        while pending or not stopping:
+            # Keep the workers busy, waiting for uploads only when there is nothing to merge
+            while not stopping and len(pending) < 2 * self.jobs:
+                try:
+                    item = self.queue.get(block=not pending)
+                except Queue.Empty:
+                    break
+                if item is None:
+                    stopping = True
+                else:
+                    file_name, queued = item
+                    pending.append((file_name, queued, self.pool.apply_async(prepare_upload, (file_name, self.key, self.copy_uploads))))
+                    self.in_progress = len(pending)
+            if not pending:
+                continue
+            file_name, queued, prepared = pending.popleft()
+            prepared_file = None
+            try:
+                prepared = prepared.get()
+                if prepared:
+                    prepared_file, content_hash = prepared
+                added = prepared is not None and self.dbmerge.add_file(out_conn, prepared_file, content_hash=content_hash)
+            except Exception as e:
+                print "Unable to ingest %s: %s" % (file_name, e)
+                added = False
+            finally:
+                if self.copy_uploads and prepared_file is not None:
+                    shutil.rmtree(os.path.dirname(prepared_file), ignore_errors=True)
+            lag = time.time() - queued
+            with self.lock:
+                self.in_progress = len(pending)
+                if added:
+                    self.ingested += 1
+                    self.last_lag = lag
+                    self.total_lag += lag
+                else:
+                    self.failed += 1
+            if added:
+                print "Ingested %s, %.1f seconds after upload, %d waiting" % (file_name, lag, self.queue.qsize() + len(pending))
+        out_conn.close()
+    
+    def metrics(self):
+        '''Returns the number of queued and in progress uploads, counts of ingested, failed and dropped uploads, and ingest lag in seconds'''
+        with self.lock:
+            return dict(queue_depth=self.queue.qsize(), in_progress=self.in_progress, ingested=self.ingested, failed=self.failed, 
+                        dropped=self.dropped, last_lag=self.last_lag, total_lag=self.total_lag)
+    
+    def stop(self):
+        '''Ingests the queued uploads, then stops the writer and workers'''
+        self.queue.put(None)
+        while self.writer.is_alive():
+            self.writer.join(1)
+        self.pool.close()
+        self.pool.join()
+
+ingester = None
+
+def handle_get(path, query, headers):
+    '''Returns the status code, body and extra headers of the response to a GET request, with no body for errors'''
+    if path == config_path:
+        query = urlparse.parse_qs(query)
+        study = query.get('study', [None])[0]
+        entry = config_index.get(study, query.get('device', [None])[0])
+        if entry:
+            config, gzipped_config, etag = entry
+            gzipped = accepts_gzip(headers)
+            if gzipped:
+                # Each content coding of the config needs its own strong validator
+                etag = etag[:-1] + '-gz"'
+            response_headers = [('ETag', etag), ('Vary', 'Accept-Encoding')]
+            if etag in [tag.strip() for tag in headers.get('If-None-Match', '').split(',')]:
+                return 304, '', response_headers
+            response_headers.append(('Content-Type', 'application/json'))
+            if gzipped:
+                return 200, gzipped_config, response_headers + [('Content-Encoding', 'gzip')]
+            return 200, config, response_headers
+        elif study is not None:
+            return 404, None, ()
+        else:
+            return 500, None, ()
+    elif path == metrics_path:
+        return 200, metrics.render(ingest_gauges()), [('Content-Type', 'text/plain; version=0.0.4')]
+    elif path.startswith(chunked_upload_path + '/'):
+        upload = chunked_uploads.get(path[len(chunked_upload_path) + 1:])
+        if upload is None:
+            return 404, None, ()
+        return 200, upload.status(), [('Content-Type', 'application/json')]
+    elif path in (upload_path, chunked_upload_path):
+        return 405, None, ()
+    else:
+        return 404, None, ()
+
+def check_post(headers):
+    '''Returns the status code of the error response to a multipart upload, or None if its body should be read'''
+    ctype, pdict = cgi.parse_header(headers.get('Content-Type', ''))
+    if ctype != 'multipart/form-data' or not pdict.get('boundary'):
+        return 400
+    try:
+        length = int(headers.get('Content-Length'))
+    except (TypeError, ValueError):
+        return 411
+    if length > max_upload_size:
+        return 413
+    if ingester is not None and ingester.full():
+        return 503
+    return None
+
+def upload_parser(headers):
+    ctype, pdict = cgi.parse_header(headers['Content-Type'])
+    return UploadParser(pdict['boundary'])
+
+def stored_upload(path, new):
+    '''Returns the status code and body of the response once an upload is stored'''
+    if new and ingester is not None:
+        ingester.put(path)
+    return 200, "OK"
+
+def finish_upload(parser):
+    '''Returns the status code and body of the response once the whole body has been fed to the parser'''
+    try:
+        stored = parser.close()
+    except ValueError as e:
+        print e
+        return 400, None
+    except (IOError, OSError) as e:
+        print e
+        parser.abort()
+        return 500, None
+    if stored is None:
+        return 400, None
+    metrics.observe('funf_multipart_parse_seconds', parser.parse_seconds)
+    metrics.observe('funf_upload_write_seconds', parser.write_seconds)
+    return stored_upload(*stored)
+
+def create_chunked_upload(query):
+    '''Starts a chunked upload of the file name and size in the query, returning its id in the body of the response'''
+    name = safe_filename(query.get('name', [''])[0])
+    try:
+        size = int(query.get('size', [''])[0])
+    except ValueError:
+        return 400, None
+    if not name or size < 0:
+        return 400, None
+    if size > max_upload_size:
+        return 413, None
+    upload = chunked_uploads.create(name, size)
+    if upload is None:
+        return 503, None
+    return 201, upload.id, [('Location', '%s/%s' % (chunked_upload_path, upload.id))]
+
+def chunk_receiver(upload, headers):
+    '''Returns a receiver for the byte range in the Content-Range header of a PUT request, or the status code of the error response'''
+    match = re.match(r'bytes (\d+)-(\d+)/(\d+|\*)$', headers.get('Content-Range', '').strip())
+    if not match:
+        return 400
+    start, end = int(match.group(1)), int(match.group(2))
+    try:
+        length = int(headers.get('Content-Length'))
+    except (TypeError, ValueError):
+        return 411
+    if end < start or end >= upload.size or length != end - start + 1 or match.group(3) not in ('*', str(upload.size)):
+        return 416
+    if not upload.start_write():
+        return 404
+    return ChunkReceiver(upload, start)
+
+def finish_chunked_upload(upload, query):
+    '''Stores a chunked upload once all of it has been received, no range is being written, and its sha1 matches the one in the query, if any'''
+    with upload.lock:
+        if upload.finished:
+            return 404, None
+        if upload.writers or not upload.complete():
+            return 409, upload.status(), [('Content-Type', 'application/json')]
+        sha1 = query.get('sha1', [None])[0]
+        if sha1 is not None and sha1.lower() != upload.hexdigest():
+            return 400, None
+        if ingester is not None and ingester.full():
+            return 503, None
+        upload.finished = True
+        try:
+            stored = store_upload(upload.name, upload)
+        except:
+            upload.finished = False
+            raise
+    # Removed once stored, so the upload is not read again from its state file while it is finished
+    chunked_uploads.remove(upload)
+    return stored_upload(*stored)
+
+def start_body(command, path, query, headers):
+    '''Returns a receiver for the body of a POST or PUT request, which is fed the body and then returns the response from finish().  
+    Requests without a body to receive get None, and the status code, body and extra headers of their response.'''
+    if path == upload_path and command == 'POST':
+        code = check_post(headers)
+        if code:
+            return None, (code, None)
+        return upload_parser(headers), None
+    elif path == chunked_upload_path and command == 'POST':
+        return None, create_chunked_upload(urlparse.parse_qs(query))
+    elif path.startswith(chunked_upload_path + '/'):
+        upload = chunked_uploads.get(path[len(chunked_upload_path) + 1:])
+        if upload is None:
+            return None, (404, None)
+        if command == 'POST':
+            return None, finish_chunked_upload(upload, urlparse.parse_qs(query))
+        receiver = chunk_receiver(upload, headers)
+        if isinstance(receiver, int):
+            return None, (receiver, None)
+        return receiver, None
+    elif path in (upload_path, chunked_upload_path, config_path):
+        return None, (405, None)
+    else:
+        return None, (404, None)
+
+def handle_body(command, path, query, headers, body_file):
+    '''Returns the status code, body and extra headers of the response to a POST or PUT request, with no body for errors'''
+    receiver, response = start_body(command, path, query, headers)
+    if response:
+        return response
+    remaining = int(headers['Content-Length'])
+    try:
+        while remaining > 0:
+            chunk = body_file.read(min(buffer_size, remaining))
             if not chunk:
                 break
-            output_file.write(chunk)
+            remaining -= len(chunk)
+            metrics.inc('funf_upload_bytes_total', len(chunk))
+            receiver.feed(chunk)
+    except ValueError as e:
+        print e
+        receiver.abort()
+        return 400, None
+    except:
+        receiver.abort()
+        raise
+    return receiver.finish()
 
 class RequestHandler(BaseHTTPRequestHandler):
     
+    def setup(self):
+        BaseHTTPRequestHandler.setup(self)
+        metrics.inc('funf_connections_in_flight')
+    
+    def finish(self):
+        metrics.inc('funf_connections_in_flight', -1)
+        BaseHTTPRequestHandler.finish(self)
+    
     def do_GET(self):
+        self.started = time.time()
         parsed_url = urlparse.urlparse(self.path)
-        if parsed_url.path == config_path:
-            config = read_config()
-            if config:
-                self.send_response(200)
-                self.end_headers()
-                self.wfile.write(config)
-            else:
-                self.send_error(500)
-        elif parsed_url.path == upload_path:
-            self.send_error(405)
-        else:
-            self.send_error(404)
+        self.send_result(*handle_get(parsed_url.path, parsed_url.query, self.headers))
     
     def do_POST(self):
+        self.started = time.time()
         parsed_url = urlparse.urlparse(self.path)
-        path = parsed_url.path
-        ctype, pdict = cgi.parse_header(self.headers['Content-Type']) 
-        if path == upload_path:
-            if ctype=='multipart/form-data':
-                form = cgi.FieldStorage(self.rfile, self.headers, environ={'REQUEST_METHOD':'POST'})
-                try:
-                    fileitem = form["uploadedfile"]
-                    if fileitem.file:
-                        try:
-                            write_file(fileitem.filename, fileitem.file)
-                        except Exception as e:
-                            print e
-                            self.send_error(500)
-                        else:
-                            self.send_response(200)
-                            self.end_headers()
-                            self.wfile.write("OK")
-                        return
-                except KeyError:
-                    pass
-            # Bad request
-            self.send_error(400)
-        elif parsed_url.path == config_path:
-            self.send_error(405)
+        self.send_result(*handle_body(self.command, parsed_url.path, parsed_url.query, self.headers, self.rfile))
+    
+    do_PUT = do_POST
+    
+    def send_result(self, code, body, extra_headers=()):
+        if body is None and code != 503:
+            self.send_error(code)
         else:
-            self.send_error(404)
+            if body is None:
+                body = '%d %s\n' % (code, self.responses[code][0])
+                extra_headers = [('Content-Type', 'text/plain'), ('Retry-After', str(retry_after))]
+            self.send_response(code)
+            for header in extra_headers:
+                self.send_header(*header)
+            self.end_headers()
+            self.wfile.write(body)
+        record_request(self.client_address, self.command, urlparse.urlparse(self.path).path, code, len(body or ''), self.started)
+    
+    def log_request(self, code='-', size='-'):
+        if access_log is None:
+            BaseHTTPRequestHandler.log_request(self, code, size)
         
 
 class ThreadedHTTPServer(ThreadingMixIn, HTTPServer):
     """Handle requests in a separate thread."""                
 
+
+class AsyncRequestHandler(asynchat.async_chat):
+    '''Reads requests from one connection on the event loop.  
+    The connection is kept open between requests unless the client, or a server that is shutting down, closes it.'''
+    
+    ac_in_buffer_size = 65536
+    ac_out_buffer_size = 65536
+    max_header_size = 65536
+    
+    def __init__(self, sock, client_address, server):
+        asynchat.async_chat.__init__(self, sock, map=server.map)
+        self.client_address = client_address
+        self.server = server
+        self.keep_alive = False
+        self.closing = False
+        self.waiting = False
+        self.replay_data = ''
+        self.last_activity = time.time()
+        metrics.inc('funf_connections_in_flight')
+        self.counted = True
+        self.reset()
+    
+    def reset(self):
+        self.header_data = []
+        self.header_size = 0
+        self.request_line = None
+        self.command = None
+        self.path = None
+        self.started = None
+        self.headers = None
+        self.upload = None
+        self.set_terminator('\r\n\r\n')
+    
+    def busy(self):
+        '''True while a request is being read, handled on a worker, or a response is being sent'''
+        return bool(self.waiting or self.header_size or self.headers is not None or self.producer_fifo)
+    
+    def readable(self):
+        return not self.closing and not self.waiting and asynchat.async_chat.readable(self)
+    
+    def recv(self, buffer_size):
+        # Data read before a request was handed to a worker is read again once it is done
+        if self.replay_data:
+            data, self.replay_data = self.replay_data, ''
+            return data
+        return asynchat.async_chat.recv(self, buffer_size)
+    
+    def defer(self, callback, function, *args):
+        '''Runs function on the server's worker threads, and then callback with its result on the event loop.  
+        Nothing more is read from the connection until then.'''
+        self.waiting = True
+        self.replay_data, self.ac_in_buffer = self.ac_in_buffer, ''
+        waker = self.server.waker
+        self.server.workers.apply_async(call_on_worker, (function,) + args, 
+                                        callback=lambda result: waker.call(self.resume, callback, result))
+    
+    def resume(self, callback, result):
+        self.waiting = False
+        value, error = result
+        if error is not None:
+            if self.connected:
+                self.keep_alive = False
+                self.send_result(500, None)
+        else:
+            callback(value)
+        if self.replay_data and self.connected and not self.waiting and not self.closing:
+            self.handle_read()
+    
+    def handle_write(self):
+        self.last_activity = time.time()
+        asynchat.async_chat.handle_write(self)
+    
+    def close(self):
+        if self.upload is not None:
+            self.upload.abort()
+            self.upload = None
+        # A hangup can close the connection more than once, from both the poll flags and the empty read
+        if self.counted:
+            self.counted = False
+            metrics.inc('funf_connections_in_flight', -1)
+        asynchat.async_chat.close(self)
+    
+    def collect_incoming_data(self, data):
+        self.last_activity = time.time()
+        if self.closing:
+            return
+        if self.upload is not None:
+            metrics.inc('funf_upload_bytes_total', len(data))
+            try:
+                self.upload.feed(data)
+            except ValueError as e:
+                print e
+                self.keep_alive = False
+                self.send_result(400, None)
+        else:
+            self.header_size += len(data)
+            self.header_data.append(data)
+            if self.header_size > self.max_header_size:
+                self.keep_alive = False
+                self.send_result(400, None)
+    
+    def found_terminator(self):
+        if self.closing:
+            return
+        if self.headers is None:
+            self.read_headers()
+        else:
+            self.finish_upload()
+    
+    def read_headers(self):
+        request = ''.join(self.header_data).lstrip('\r\n')
+        self.header_data = []
+        if not request:
+            self.reset()
+            return
+        lines = request.split('\r\n', 1)
+        self.request_line = lines[0]
+        words = self.request_line.split()
+        if len(words) != 3:
+            self.keep_alive = False
+            self.send_result(400, None)
+            return
+        self.command, self.path, self.request_version = words
+        self.started = time.time()
+        self.headers = mimetools.Message(StringIO(lines[1] + '\r\n\r\n' if len(lines) > 1 else '\r\n'), 0)
+        connection = self.headers.get('Connection', '').lower()
+        if self.request_version == 'HTTP/1.1':
+            self.keep_alive = connection != 'close'
+        else:
+            self.keep_alive = connection == 'keep-alive'
+        parsed_url = urlparse.urlparse(self.path)
+        path = parsed_url.path
+        if self.command == 'GET':
+            self.send_result(*handle_get(path, parsed_url.query, self.headers))
+        elif self.command in ('POST', 'PUT'):
+            self.defer(self.start_upload, start_body, self.command, path, parsed_url.query, self.headers)
+        else:
+            self.keep_alive = False
+            self.send_result(501, None)
+    
+    def start_upload(self, result):
+        upload, response = result
+        if not self.connected:
+            if upload is not None:
+                upload.abort()
+            return
+        self.upload = upload
+        if response:
+            if self.headers.get('Content-Length', '0').strip() != '0':
+                # The body is not read
+                self.keep_alive = False
+            self.send_result(*response)
+            return
+        if self.headers.get('Expect', '').lower() == '100-continue':
+            self.push('HTTP/1.1 100 Continue\r\n\r\n')
+        length = int(self.headers['Content-Length'])
+        if length > 0:
+            self.set_terminator(length)
+        else:
+            self.finish_upload()
+    
+    def finish_upload(self):
+        upload, self.upload = self.upload, None
+        self.defer(self.finished_upload, upload.finish)
+    
+    def finished_upload(self, response):
+        if self.connected:
+            self.send_result(*response)
+    
+    def send_result(self, code, body, extra_headers=()):
+        '''Sends a response, then waits for the next request or closes the connection'''
+        if self.upload is not None:
+            self.upload.abort()
+            self.upload = None
+        if body is None:
+            body = '%d %s\n' % (code, BaseHTTPRequestHandler.responses[code][0])
+            extra_headers = [('Content-Type', 'text/plain')] + list(extra_headers)
+            if code == 503:
+                extra_headers.append(('Retry-After', str(retry_after)))
+        if self.server.shutting_down:
+            self.keep_alive = False
+        headers = [('Server', 'FunfServer'), ('Date', formatdate(usegmt=True))]
+        if code != 304:
+            headers.append(('Content-Length', str(len(body))))
+        headers = headers + [('Connection', 'keep-alive' if self.keep_alive else 'close')] + list(extra_headers)
+        self.push(''.join(['HTTP/1.1 %d %s\r\n' % (code, BaseHTTPRequestHandler.responses[code][0])] + 
+                          ['%s: %s\r\n' % header for header in headers] + ['\r\n', body]))
+        self.log_request(code, len(body))
+        record_request(self.client_address, self.command, urlparse.urlparse(self.path or '').path, code, len(body), self.started)
+        if self.keep_alive:
+            self.reset()
+        else:
+            self.closing = True
+            self.close_when_done()
+    
+    def log_request(self, code, size):
+        if access_log is None:
+            sys.stderr.write('%s - - [%s] "%s" %d %d\n' % (self.client_address[0], 
+                             time.strftime('%d/%b/%Y %H:%M:%S'), self.request_line or '-', code, size))
+
+
+def call_on_worker(function, *args):
+    '''Returns the result of a function, and None, or None and the exception it raised'''
+    try:
+        return function(*args), None
+    except Exception as e:
+        print "Error handling request: %s" % e
+        return None, e
+
+class LoopWaker(asyncore.dispatcher):
+    '''Runs functions passed to call() from other threads on the event loop, waking it up through a socket pair'''
+    
+    def __init__(self, map):
+        self.reader, self.writer = socket.socketpair()
+        asyncore.dispatcher.__init__(self, self.reader, map=map)
+        self.lock = threading.Lock()
+        self.calls = collections.deque()
+    
+    def call(self, function, *args):
+        with self.lock:
+            self.calls.append((function, args))
+        try:
+            self.writer.send('x')
+        except socket.error:
+            # The loop is already awake, or has stopped
+            pass
+    
+    def writable(self):
+        return False
+    
+    def handle_read(self):
+        self.recv(4096)
+        while True:
+            with self.lock:
+                if not self.calls:
+                    return
+                function, args = self.calls.popleft()
+            function(*args)
+    
+    def close(self):
+        asyncore.dispatcher.close(self)
+        self.writer.close()
+
+class AsyncHTTPServer(asyncore.dispatcher):
+    '''Serves all connections from a single event loop.  
+    Connections beyond max_connections get a 503 response asking the client to retry later.  
+    Request bodies are finished and stored on a pool of worker threads, so slow disk writes do not hold up other connections, 
+    and idle connections are closed at most once every idle_check_interval seconds.'''
+    
+    idle_check_interval = 1
+    
+    def __init__(self, server_address, max_connections=1000, idle_timeout=30, workers=4):
+        self.map = {}
+        asyncore.dispatcher.__init__(self, map=self.map)
+        self.max_connections = max_connections
+        self.idle_timeout = idle_timeout
+        self.shutting_down = False
+        self.shutdown_deadline = None
+        self.idle_checked = time.time()
+        self.workers = ThreadPool(workers)
+        self.waker = LoopWaker(self.map)
+        self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.set_reuse_addr()
+        self.bind(server_address)
+        self.listen(1024)
+    
+    def connections(self):
+        return [connection for connection in self.map.values() if connection is not self and connection is not self.waker]
+    
+    def handle_accept(self):
+        pair = self.accept()
+        if pair is None:
+            return
+        sock, client_address = pair
+        connection = AsyncRequestHandler(sock, client_address, self)
+        if len(self.connections()) > self.max_connections:
+            connection.send_result(503, None)
+    
+    def close_idle_connections(self):
+        now = time.time()
+        self.idle_checked = now
+        for connection in self.connections():
+            if connection.waiting:
+                continue
+            if (self.shutting_down and not connection.busy()) or now - connection.last_activity > self.idle_timeout:
+                connection.close()
+    
+    def serve_forever(self):
+        '''Runs the event loop until the server has shut down and its last connection is closed, 
+        then waits for the workers to store the uploads they are finishing'''
+        while [channel for channel in self.map.values() if channel is not self.waker]:
+            asyncore.loop(timeout=1, use_poll=True, map=self.map, count=1)
+            if self.shutting_down or time.time() - self.idle_checked >= self.idle_check_interval:
+                self.close_idle_connections()
+            if access_log is not None:
+                access_log.flush(force=False)
+            if self.shutting_down and time.time() > self.shutdown_deadline:
+                asyncore.close_all(self.map)
+        self.waker.close()
+        self.workers.close()
+        self.workers.join()
+    
+    def shutdown(self, grace_period=30):
+        '''Stops accepting connections, and gives open requests grace_period seconds to finish.
+        Shutting down a second time closes all connections right away.'''
+        if self.shutting_down:
+            self.shutdown_deadline = 0
+        else:
+            self.shutting_down = True
+            self.shutdown_deadline = time.time() + grace_period
+            self.close()
+
     
 if __name__ == '__main__':
-    if sys.argv[1:]:
-        port = int(sys.argv[1])
+    usage = "%prog [options] [port]"
+    description = "Serves a Funf configuration file at %s and accepts uploads of data files at %s." % (config_path, upload_path)
+    parser = OptionParser(usage="%s\n\n%s" % (usage, description))
+    parser.add_option("-a", "--async", dest="async", action="store_true", default=False,
+                      help="Serve all connections from one event loop instead of a thread per connection.  Connections are kept alive between requests.")
+    parser.add_option("-c", "--max-connections", dest="max_connections", type="int", default=1000,
+                      help="With --async, the number of open connections above which clients get a 503 response asking them to retry later.  Defaults to 1000.")
+    parser.add_option("-t", "--idle-timeout", dest="idle_timeout", type="int", default=30,
+                      help="With --async, seconds after which an inactive connection is closed.  Defaults to 30.")
+    parser.add_option("-w", "--workers", dest="workers", type="int", default=4,
+                      help="With --async, number of threads that start and finish uploads, writing and storing them off the event loop.  Defaults to 4.")
+    parser.add_option("-d", "--config-dir", dest="config_dir", default=None,
+                      help="Directory of study configs, served at %s?study=<name> from <name>.json.  A devices.json file in it maps device ids to study names, for %s?device=<id>." % (config_path, config_path))
+    parser.add_option("-m", "--max-upload-size", dest="max_upload_size", type="int", default=max_upload_size / (1024 * 1024),
+                      help="Largest upload body accepted, in megabytes.  Larger uploads get a 413 response.  Defaults to %d." % (max_upload_size / (1024 * 1024)))
+    parser.add_option("-u", "--upload-dir", dest="upload_dir", default=upload_dir,
+                      help="Directory uploaded files are written to.  Defaults to the uploads directory next to this script.")
+    parser.add_option("-s", "--content-addressed", dest="content_addressed", action="store_true", default=False,
+                      help="Store uploads in the upload directory under the hash of their contents, so files uploaded more than once are only stored once.  Names are recorded in %s there." % ContentStore.index_file_name)
+    parser.add_option("-l", "--access-log", dest="access_log", default=None, metavar="FILE",
+                      help="Append a json line for each request to FILE, written in batches, instead of logging each request to stderr.")
+    parser.add_option("-i", "--ingest", dest="ingest", default=None, metavar="FILE",
+                      help="Decrypt, salvage and merge uploaded files into this merged db file as they arrive.")
+    parser.add_option("-j", "--ingest-jobs", dest="ingest_jobs", type="int", default=1,
+                      help="With --ingest, number of worker processes decrypting and salvaging uploads.  Defaults to 1.")
+    parser.add_option("-q", "--ingest-queue", dest="ingest_queue", type="int", default=1000,
+                      help="With --ingest, number of uploads that can wait to be ingested.  Uploads get a 503 response while the queue is full.  Defaults to 1000.")
+    parser.add_option("-k", "--key", dest="key", default=None,
+                      help="With --ingest, the DES key used to decrypt uploads.  Prompts for the password if one is not supplied.")
+    parser.add_option("-x", "--indexed", dest="indexed", action="store_true", default=False,
+                      help="With --ingest, create the merged db with the indexed schema of dbmerge.py.")
+    (options, args) = parser.parse_args()
+    if args:
+        port = int(args[0])
     else:
         port = 8000
+    upload_dir = options.upload_dir
+    max_upload_size = options.max_upload_size * 1024 * 1024
+    config_index = ConfigIndex(options.config_dir)
+    config_index.start()
+    if options.content_addressed:
+        content_store = ContentStore(upload_dir)
+    if options.access_log:
+        access_log = AccessLog(options.access_log)
+    if options.ingest:
+        sys.path.append(data_processing_dir)
+        import decrypt
+        key = options.key if options.key else decrypt.key_from_password(decrypt.prompt_for_password())
+        ingester = Ingester(options.ingest, key, options.ingest_jobs, options.ingest_queue, options.indexed, options.content_addressed)
     server_address = ('', port)
-    httpd = ThreadedHTTPServer(server_address, RequestHandler)
+    if options.async:
+        httpd = AsyncHTTPServer(server_address, options.max_connections, options.idle_timeout, options.workers)
+        stop = lambda signum, frame: httpd.shutdown()
+        signal.signal(signal.SIGINT, stop)
+        signal.signal(signal.SIGTERM, stop)
+    else:
+        httpd = ThreadedHTTPServer(server_address, RequestHandler)
+        if access_log is not None:
+            access_log.start()
+    signal.signal(signal.SIGHUP, lambda signum, frame: config_index.reload())
 
     sa = httpd.socket.getsockname()
     print "Serving HTTP on", sa[0], "port", sa[1], "..."
     print 'use <Ctrl-C> to stop'
-    httpd.serve_forever()
-
-
+    try:
+        httpd.serve_forever()
+    finally:
+        if ingester is not None:
+            ingester.stop()
+        if access_log is not None:
+            access_log.flush()
@@ -0,0 +1,151 @@
+#!/usr/bin/env python
+#
+# Funf: Open Sensing Framework
+# Copyright (C) 2010-2011 Nadav Aharony, Wei Pan, Alex Pentland.
+# Acknowledgments: Alan Gardner
+# Contact: nadav@media.mit.edu
+#
+# This file is part of Funf.
+#
+# Funf is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as
+# published by the Free Software Foundation, either version 3 of
+# the License, or (at your option) any later version.
+#
+# Funf is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with Funf. If not, see <http://www.gnu.org/licenses/>.
+#
+
+'''Tests a funfserver running on a free port
+'''
+import unittest
+import subprocess
+import tempfile
+import shutil
+import httplib
+import socket
+import struct
+import time
+import os
+import sys
+
+server_dir = os.path.dirname(os.path.abspath(__file__))
+
+def free_port():
+    sock = socket.socket()
+    sock.bind(('localhost', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+class ServerTest(unittest.TestCase):
+    '''Starts a server with the options of server_options for each test'''
+
+    server_options = ()
+
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp()
+        self.port = free_port()
+        self.output = open(os.path.join(self.work_dir, 'server.log'), 'w')
+        self.server = subprocess.Popen([sys.executable, os.path.join(server_dir, 'funfserver.py'), str(self.port),
+                                        '-u', os.path.join(self.work_dir, 'uploads')] + list(self.server_options),
+                                       stdout=self.output, stderr=subprocess.STDOUT)
+        for i in range(100):
+            try:
+                socket.create_connection(('localhost', self.port)).close()
+                break
+            except socket.error:
+                time.sleep(0.05)
+
+    def tearDown(self):
+        self.server.terminate()
+        self.server.wait()
+        self.output.close()
+        shutil.rmtree(self.work_dir)
+
+    def connection(self):
+        return httplib.HTTPConnection('localhost', self.port)
+
+    def request(self, method, path, body=None, headers={}):
+        conn = self.connection()
+        try:
+            conn.request(method, path, body, headers)
+            response = conn.getresponse()
+            return response.status, response.read()
+        finally:
+            conn.close()
+
+    def metric(self, name):
+        '''Returns the value of a metric without labels'''
+        status, body = self.request('GET', '/metrics')
+        for line in body.splitlines():
+            if line.startswith(name + ' '):
+                return float(line.split()[1])
+        return None
+
+class AsyncConnectionsTest(ServerTest):
+
+    server_options = ('-a',)
+
+    def test_connections_in_flight(self):
+        for i in range(5):
+            conn = self.connection()
+            conn.request('GET', '/config')
+            conn.getresponse().read()
+            conn.close()
+        for i in range(3):
+            sock = socket.create_connection(('localhost', self.port))
+            # Closing with a zero linger time resets the connection
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER, struct.pack('ii', 1, 0))
+            sock.sendall('GET /config HTTP/1.1\r\n')
+            time.sleep(0.1)
+            sock.close()
+        time.sleep(0.5)
+        # Only the connection asking for the metrics is open
+        self.assertEqual(self.metric('funf_connections_in_flight'), 1)
+
+class ChunkedUploadTest(ServerTest):
+
+    def create(self, size):
+        status, upload_id = self.request('POST', '/data/uploads?name=funf.db&size=%d' % size)
+        self.assertEqual(status, 201)
+        return '/data/uploads/' + upload_id
+
+    def put(self, path, data, start=0, size=None):
+        headers = {'Content-Range': 'bytes %d-%d/%d' % (start, start + len(data) - 1, size or len(data))}
+        return self.request('PUT', path, data, headers)[0]
+
+    def test_finish_while_writing(self):
+        path = self.create(8)
+        self.assertEqual(self.put(path, 'abcdefgh'), 200)
+        # A range whose body has not all arrived is still being written
+        writer = self.connection()
+        writer.putrequest('PUT', path)
+        writer.putheader('Content-Range', 'bytes 0-7/8')
+        writer.putheader('Content-Length', '8')
+        writer.endheaders()
+        writer.send('abcd')
+        time.sleep(0.2)
+        self.assertEqual(self.request('POST', path)[0], 409)
+        writer.send('efgh')
+        self.assertEqual(writer.getresponse().status, 200)
+        writer.close()
+        self.assertEqual(self.request('POST', path)[0], 200)
+        self.assertEqual(self.request('POST', path)[0], 404)
+        self.assertEqual(self.put(path, 'abcdefgh'), 404)
+        partial_dir = os.path.join(self.work_dir, 'uploads', '.partial')
+        self.assertEqual(os.listdir(partial_dir), [])
+        with open(os.path.join(self.work_dir, 'uploads', 'funf.db')) as uploaded:
+            self.assertEqual(uploaded.read(), 'abcdefgh')
+
+class AsyncChunkedUploadTest(ChunkedUploadTest):
+
+    server_options = ('-a',)
+
+if __name__ == '__main__':
+    unittest.main()